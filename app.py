@@ -1,19 +1,32 @@
-from flask import Flask, render_template, request, redirect, session, flash, url_for, jsonify, g
+from flask import Flask, Request, render_template, request, redirect, session, flash, url_for, jsonify, g, has_request_context
 import pandas as pd
 import os
 import datetime
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestEntityTooLarge
 import math
 from flask_sqlalchemy import SQLAlchemy
-import csv
 from flask_migrate import Migrate
-from markupsafe import Markup
+from markupsafe import Markup, escape
 from flask_login import UserMixin
-import random
 import re
 import time
-from datetime import datetime
+import hashlib
+import tempfile
+import json
+import base64
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
 from flask_socketio import SocketIO, emit, join_room, leave_room
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.schema import CreateColumn
+from PIL import Image, ImageOps
+import atexit
+import click
 
 # In-memory typing status: {('user1', 'user2'): timestamp}
 typing_status = {}
@@ -21,13 +34,12 @@ typing_status = {}
 app = Flask(__name__)
 print("App started, registering routes...")
 
+# Markup is built once when the text is written (render_tags_and_mentions); the filter only marks it safe
 @app.template_filter('highlight_tags_and_mentions')
-def highlight_tags_and_mentions(text):
-    if not text:
+def highlight_tags_and_mentions(html):
+    if not html:
         return ''
-    text = re.sub(r'#(\w+)', r'<a href="/hashtag/\1" class="text-primary">#\1</a>', text)
-    text = re.sub(r'@(\w+)', r'<a href="/user/\1" class="text-success">@\1</a>', text)
-    return Markup(text)
+    return Markup(html)
 
 print("highlight_tags_and_mentions filter registered")
 
@@ -49,11 +61,14 @@ os.makedirs(TRIP_GALLERY_FOLDER, exist_ok=True)
 TRIP_PHOTOS_FILE = 'trip_photos.csv'
 REPORTS_FILE = 'reports.csv'
 
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///partner_web.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///partner_web.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 db = SQLAlchemy(app)
 migrate = Migrate(app, db)
 
+# Shared pool for work that should not hold up a request (timeline fan-out, ranking refresh)
+background_executor = ThreadPoolExecutor(max_workers=2)
+
 
 
 class User(db.Model, UserMixin):
@@ -65,6 +80,7 @@ class User(db.Model, UserMixin):
     profile_pic = db.Column(db.String(120))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
     profile_pic_updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+    unread_notifications = db.Column(db.Integer, nullable=False, default=0, server_default='0')
     def __init__(self, username, password, bio=None, interests=None, profile_pic=None, last_seen=None, profile_pic_updated_at=None):
         self.username = username
         self.password = password
@@ -73,6 +89,7 @@ class User(db.Model, UserMixin):
         self.profile_pic = profile_pic
         self.last_seen = last_seen if last_seen is not None else datetime.utcnow()
         self.profile_pic_updated_at = profile_pic_updated_at if profile_pic_updated_at is not None else datetime.utcnow()
+        self.unread_notifications = 0
 
 class Trip(db.Model):
     trip_id = db.Column(db.Integer, primary_key=True)
@@ -85,8 +102,8 @@ class Trip(db.Model):
     participants = db.Column(db.String(500)) # Comma-separated list of usernames
     latitude = db.Column(db.Float)  # Added for map accuracy
     longitude = db.Column(db.Float) # Added for map accuracy
-    def __init__(self, trip_id, creator, destination, start_date, end_date, description=None, preferences=None, participants=None, latitude=None, longitude=None):
-        self.trip_id = trip_id
+    __table_args__ = {'sqlite_autoincrement': True}
+    def __init__(self, creator, destination, start_date, end_date, description=None, preferences=None, participants=None, latitude=None, longitude=None):
         self.creator = creator
         self.destination = destination
         self.start_date = start_date
@@ -97,23 +114,62 @@ class Trip(db.Model):
         self.latitude = latitude
         self.longitude = longitude
 
+MESSAGE_TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Messages were stored both as formatted strings and as str(datetime) with microseconds
+def parse_message_timestamp(value):
+    if isinstance(value, datetime):
+        return value.replace(microsecond=0)
+    try:
+        return datetime.fromisoformat(str(value).strip()).replace(microsecond=0, tzinfo=None)
+    except ValueError:
+        return None
+
 class Message(db.Model):
     message_id = db.Column(db.Integer, primary_key=True)
     sender = db.Column(db.String(80), nullable=False)
     receiver = db.Column(db.String(80), nullable=False)
-    timestamp = db.Column(db.String(50), nullable=False)
+    timestamp = db.Column(db.String(50), nullable=False) # Display string, '%Y-%m-%d %H:%M:%S'
+    sent_at = db.Column(db.DateTime, nullable=True) # Parsed timestamp; normalize-message-timestamps fills older rows
     content = db.Column(db.Text, nullable=False)
     is_read = db.Column(db.Integer, default=0) # 0 = unread, 1 = read
     attachment = db.Column(db.String(255), nullable=True)  # store filename if any
-    def __init__(self, message_id, sender, receiver, timestamp, content, is_read=0, attachment=None):
-        self.message_id = message_id
+    __table_args__ = (
+        db.Index('ix_message_sender_receiver_message_id', 'sender', 'receiver', 'message_id'),
+        db.Index('ix_message_sent_at', 'sent_at'),
+        {'sqlite_autoincrement': True},
+    )
+    def __init__(self, sender, receiver, timestamp, content, is_read=0, attachment=None):
         self.sender = sender
         self.receiver = receiver
-        self.timestamp = timestamp
+        self.sent_at = parse_message_timestamp(timestamp)
+        self.timestamp = self.sent_at.strftime(MESSAGE_TIMESTAMP_FORMAT) if self.sent_at else str(timestamp)
         self.content = content
         self.is_read = is_read
         self.attachment = attachment
 
+class Conversation(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), nullable=False) # Whose sidebar this row belongs to
+    partner = db.Column(db.String(80), nullable=False)
+    last_message_id = db.Column(db.Integer, db.ForeignKey('message.message_id'), nullable=False)
+    last_sender = db.Column(db.String(80), nullable=False)
+    last_message = db.Column(db.Text, nullable=False)
+    last_timestamp = db.Column(db.String(50), nullable=False)
+    unread_count = db.Column(db.Integer, nullable=False, default=0, server_default='0') # Messages from partner not yet read by username
+    __table_args__ = (
+        db.UniqueConstraint('username', 'partner', name='uq_conversation_username_partner'),
+        db.Index('ix_conversation_username_last_message_id', 'username', 'last_message_id'),
+    )
+    def __init__(self, username, partner, last_message_id, last_sender, last_message, last_timestamp, unread_count=0):
+        self.username = username
+        self.partner = partner
+        self.last_message_id = last_message_id
+        self.last_sender = last_sender
+        self.last_message = last_message
+        self.last_timestamp = last_timestamp
+        self.unread_count = unread_count
+
 class Review(db.Model):
     review_id = db.Column(db.Integer, primary_key=True)
     reviewer = db.Column(db.String(80), nullable=False)
@@ -122,8 +178,8 @@ class Review(db.Model):
     rating = db.Column(db.Integer, nullable=False)
     comment = db.Column(db.Text)
     timestamp = db.Column(db.String(50), nullable=False)
-    def __init__(self, review_id, reviewer, reviewee, trip_id, rating, comment, timestamp):
-        self.review_id = review_id
+    __table_args__ = {'sqlite_autoincrement': True}
+    def __init__(self, reviewer, reviewee, trip_id, rating, comment, timestamp):
         self.reviewer = reviewer
         self.reviewee = reviewee
         self.trip_id = trip_id
@@ -138,13 +194,36 @@ class Notification(db.Model):
     message = db.Column(db.Text, nullable=False)
     is_read = db.Column(db.Integer, default=0)
     timestamp = db.Column(db.String(50), nullable=False)
-    def __init__(self, notification_id, username, type, message, is_read, timestamp):
-        self.notification_id = notification_id
+    actor = db.Column(db.String(80), db.ForeignKey('user.username'), nullable=True) # Who caused it
+    trip_id = db.Column(db.Integer, db.ForeignKey('trip.trip_id'), nullable=True)
+    invitation_id = db.Column(db.Integer, db.ForeignKey('invitation.invitation_id'), nullable=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('trip_post.post_id'), nullable=True)
+    actor_count = db.Column(db.Integer, nullable=False, default=1, server_default='1') # Distinct actors folded into this row
+    __table_args__ = (
+        db.Index('ix_notification_username_timestamp_notification_id', 'username', 'timestamp', 'notification_id'),
+        db.Index('ix_notification_username_type_post_id', 'username', 'type', 'post_id'),
+        {'sqlite_autoincrement': True},
+    )
+    def __init__(self, username, type, message, is_read, timestamp, actor=None, trip_id=None, invitation_id=None, post_id=None):
         self.username = username
         self.type = type
         self.message = message
         self.is_read = is_read
         self.timestamp = timestamp
+        self.actor = actor
+        self.trip_id = trip_id
+        self.invitation_id = invitation_id
+        self.post_id = post_id
+        self.actor_count = 1
+
+class NotificationActor(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    notification_id = db.Column(db.Integer, db.ForeignKey('notification.notification_id'), nullable=False)
+    username = db.Column(db.String(80), db.ForeignKey('user.username'), nullable=False)
+    __table_args__ = (db.UniqueConstraint('notification_id', 'username', name='uq_notification_actor_notification_id_username'),)
+    def __init__(self, notification_id, username):
+        self.notification_id = notification_id
+        self.username = username
 
 class Invitation(db.Model):
     invitation_id = db.Column(db.Integer, primary_key=True)
@@ -153,8 +232,8 @@ class Invitation(db.Model):
     invitee = db.Column(db.String(80), nullable=False)
     status = db.Column(db.String(50), nullable=False) # 'pending', 'accepted', 'rejected'
     timestamp = db.Column(db.String(50), nullable=False)
-    def __init__(self, invitation_id, trip_id, inviter, invitee, status, timestamp):
-        self.invitation_id = invitation_id
+    __table_args__ = {'sqlite_autoincrement': True}
+    def __init__(self, trip_id, inviter, invitee, status, timestamp):
         self.trip_id = trip_id
         self.inviter = inviter
         self.invitee = invitee
@@ -167,8 +246,8 @@ class TripPhoto(db.Model):
     username = db.Column(db.String(80), nullable=False)
     filename = db.Column(db.String(255), nullable=False)
     timestamp = db.Column(db.String(50), nullable=False)
-    def __init__(self, photo_id, trip_id, username, filename, timestamp):
-        self.photo_id = photo_id
+    __table_args__ = {'sqlite_autoincrement': True}
+    def __init__(self, trip_id, username, filename, timestamp):
         self.trip_id = trip_id
         self.username = username
         self.filename = filename
@@ -181,8 +260,8 @@ class Report(db.Model):
     reason = db.Column(db.String(255), nullable=False)
     details = db.Column(db.Text)
     timestamp = db.Column(db.String(50), nullable=False)
-    def __init__(self, report_id, reporter, reported, reason, details, timestamp):
-        self.report_id = report_id
+    __table_args__ = {'sqlite_autoincrement': True}
+    def __init__(self, reporter, reported, reason, details, timestamp):
         self.reporter = reporter
         self.reported = reported
         self.reason = reason
@@ -195,16 +274,24 @@ class TripPost(db.Model):
     image = db.Column(db.String(255), nullable=False)
     caption = db.Column(db.Text, nullable=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    caption_html = db.Column(db.Text, nullable=True) # Escaped, linkified caption
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0') # Kept in step with trip_post_like
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0') # Kept in step with trip_post_comment
+    __table_args__ = (db.Index('ix_trip_post_timestamp_post_id', 'timestamp', 'post_id'),)
     def __init__(self, username, image, caption=None, timestamp=None):
         self.username = username
         self.image = image
         self.caption = caption
+        self.caption_html = render_tags_and_mentions(caption)
         self.timestamp = timestamp if timestamp is not None else datetime.utcnow()
+        self.like_count = 0
+        self.comment_count = 0
 
 class TripPostLike(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     post_id = db.Column(db.Integer, db.ForeignKey('trip_post.post_id'), nullable=False)
     username = db.Column(db.String(80), db.ForeignKey('user.username'), nullable=False)
+    __table_args__ = (db.UniqueConstraint('post_id', 'username', name='uq_trip_post_like_post_id_username'),)
     def __init__(self, post_id, username):
         self.post_id = post_id
         self.username = username
@@ -214,21 +301,117 @@ class TripPostComment(db.Model):
     post_id = db.Column(db.Integer, db.ForeignKey('trip_post.post_id'), nullable=False)
     username = db.Column(db.String(80), db.ForeignKey('user.username'), nullable=False)
     comment = db.Column(db.Text, nullable=False)
+    comment_html = db.Column(db.Text, nullable=True) # Escaped, linkified comment
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (db.Index('ix_trip_post_comment_post_id_id', 'post_id', 'id'),)
     def __init__(self, post_id, username, comment, timestamp=None):
         self.post_id = post_id
         self.username = username
         self.comment = comment
+        self.comment_html = render_tags_and_mentions(comment)
         self.timestamp = timestamp if timestamp is not None else datetime.utcnow()
 
 class Follow(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     follower = db.Column(db.String(80), db.ForeignKey('user.username'), nullable=False)
     followed = db.Column(db.String(80), db.ForeignKey('user.username'), nullable=False)
+    __table_args__ = (db.Index('ix_follow_followed_follower', 'followed', 'follower'),)
     def __init__(self, follower, followed):
         self.follower = follower
         self.followed = followed
 
+class PostHashtag(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    tag = db.Column(db.String(100), nullable=False) # Lowercased, without the '#'
+    post_id = db.Column(db.Integer, db.ForeignKey('trip_post.post_id'), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False) # Copy of the post's timestamp for ordering
+    __table_args__ = (
+        db.UniqueConstraint('tag', 'post_id', name='uq_post_hashtag_tag_post_id'),
+        db.Index('ix_post_hashtag_tag_timestamp_post_id', 'tag', 'timestamp', 'post_id'),
+        db.Index('ix_post_hashtag_post_id', 'post_id'),
+    )
+    def __init__(self, tag, post_id, timestamp):
+        self.tag = tag
+        self.post_id = post_id
+        self.timestamp = timestamp
+
+class PostMention(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), nullable=False) # Mentioned user, without the '@'
+    post_id = db.Column(db.Integer, db.ForeignKey('trip_post.post_id'), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (
+        db.UniqueConstraint('username', 'post_id', name='uq_post_mention_username_post_id'),
+        db.Index('ix_post_mention_username_timestamp_post_id', 'username', 'timestamp', 'post_id'),
+        db.Index('ix_post_mention_post_id', 'post_id'),
+    )
+    def __init__(self, username, post_id, timestamp):
+        self.username = username
+        self.post_id = post_id
+        self.timestamp = timestamp
+
+class HashtagCount(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    tag = db.Column(db.String(100), nullable=False)
+    bucket = db.Column(db.DateTime, nullable=False) # Start of the hour the uses fall in
+    count = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.Index('ix_hashtag_count_bucket_tag', 'bucket', 'tag'),)
+    def __init__(self, tag, bucket, count=0):
+        self.tag = tag
+        self.bucket = bucket
+        self.count = count
+
+class PostScore(db.Model):
+    post_id = db.Column(db.Integer, db.ForeignKey('trip_post.post_id'), primary_key=True)
+    score = db.Column(db.Float, nullable=False)
+    rank = db.Column(db.Integer, nullable=False, index=True, unique=True) # 1 = top of explore
+    computed_at = db.Column(db.DateTime, nullable=False)
+    def __init__(self, post_id, score, rank, computed_at):
+        self.post_id = post_id
+        self.score = score
+        self.rank = rank
+        self.computed_at = computed_at
+
+class ImageAsset(db.Model):
+    path = db.Column(db.String(300), primary_key=True) # Original upload, relative to static/
+    width = db.Column(db.Integer, nullable=False)
+    height = db.Column(db.Integer, nullable=False)
+    variants = db.Column(db.String(100), nullable=False) # Comma-separated names from IMAGE_VARIANTS
+    def __init__(self, path, width, height, variants):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.variants = variants
+
+class Blob(db.Model):
+    hash = db.Column(db.String(64), primary_key=True) # SHA-256 of the content
+    path = db.Column(db.String(300), nullable=False, unique=True) # Relative to static/
+    size = db.Column(db.Integer, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    def __init__(self, hash, path, size, ref_count=0):
+        self.hash = hash
+        self.path = path
+        self.size = size
+        self.ref_count = ref_count
+
+class TimelineEntry(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    username = db.Column(db.String(80), db.ForeignKey('user.username'), nullable=False) # Timeline owner
+    post_id = db.Column(db.Integer, db.ForeignKey('trip_post.post_id'), nullable=False)
+    author = db.Column(db.String(80), db.ForeignKey('user.username'), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False) # Copy of the post's timestamp for ordering
+    __table_args__ = (
+        db.UniqueConstraint('username', 'post_id', name='uq_timeline_entry_username_post_id'),
+        db.Index('ix_timeline_entry_username_timestamp_post_id', 'username', 'timestamp', 'post_id'),
+        db.Index('ix_timeline_entry_username_author', 'username', 'author'),
+    )
+    def __init__(self, username, post_id, author, timestamp):
+        self.username = username
+        self.post_id = post_id
+        self.author = author
+        self.timestamp = timestamp
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -238,6 +421,302 @@ def allowed_photo(filename):
 def allowed_post_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
+# --- Image derivatives: resized, metadata-free WebP variants built off the request thread ---
+IMAGE_VARIANTS = {'avatar': 128, 'card': 640, 'full': 1600} # Longest edge in pixels
+POST_IMAGE_VARIANTS = ('card', 'full')
+AVATAR_VARIANTS = ('avatar',)
+ATTACHMENT_VARIANTS = ('card',)
+image_executor = ThreadPoolExecutor(max_workers=2)
+
+def derivative_path(path, variant):
+    return f"derivatives/{path}.{variant}.webp"
+
+def variant_size(asset, variant):
+    scale = min(1.0, IMAGE_VARIANTS[variant] / max(asset.width, asset.height))
+    return max(1, round(asset.width * scale)), max(1, round(asset.height * scale))
+
+def build_image_derivatives(path, variants):
+    with Image.open(os.path.join('static', path)) as original:
+        # Apply the EXIF rotation before the metadata is dropped
+        image = ImageOps.exif_transpose(original)
+        width, height = image.size
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        for variant in variants:
+            resized = image.copy()
+            resized.thumbnail((IMAGE_VARIANTS[variant], IMAGE_VARIANTS[variant]))
+            target = os.path.join('static', derivative_path(path, variant))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # A fresh WebP encode carries no EXIF/ICC/XMP from the upload
+            resized.save(target, 'WEBP', quality=80, method=4)
+    # A shared blob can be built for several upload kinds at once, so keep the union of their variants
+    existing = db.session.get(ImageAsset, path)
+    built = set(variants) | (set(existing.variants.split(',')) if existing else set())
+    names = ','.join(variant for variant in IMAGE_VARIANTS if variant in built)
+    db.session.execute(
+        sqlite_insert(ImageAsset.__table__)
+        .values(path=path, width=width, height=height, variants=names)
+        .on_conflict_do_update(index_elements=['path'], set_={'width': width, 'height': height, 'variants': names})
+    )
+    db.session.commit()
+
+def run_image_derivatives(path, variants):
+    try:
+        with app.app_context():
+            build_image_derivatives(path, variants)
+    except Exception as e:
+        print(f"[Images] could not build derivatives for {path}: {e}")
+
+def queue_image_derivatives(path, variants):
+    image_executor.submit(run_image_derivatives, path, variants)
+
+def remove_image_derivatives(path):
+    for variant in IMAGE_VARIANTS:
+        target = os.path.join('static', derivative_path(path, variant))
+        if os.path.exists(target):
+            os.remove(target)
+    ImageAsset.query.filter_by(path=path).delete()
+
+def prefetch_image_assets(paths):
+    cache = g.setdefault('image_assets', {})
+    missing = [path for path in set(paths) if path not in cache]
+    if missing:
+        found = {asset.path: asset for asset in ImageAsset.query.filter(ImageAsset.path.in_(missing))}
+        for path in missing:
+            cache[path] = found.get(path)
+
+def get_image_asset(path):
+    prefetch_image_assets([path])
+    return g.image_assets[path]
+
+# Attributes for an <img>: derivative src/srcset with fixed dimensions, or the original until they exist
+@app.template_global()
+def responsive_image(path, sizes='100vw'):
+    asset = get_image_asset(path)
+    ready = [variant for variant in POST_IMAGE_VARIANTS if asset and variant in asset.variants.split(',')]
+    if not ready:
+        return Markup('src="{0}"').format(url_for('static', filename=path))
+    srcset = ', '.join(
+        f"{url_for('static', filename=derivative_path(path, variant))} {variant_size(asset, variant)[0]}w"
+        for variant in ready
+    )
+    width, height = variant_size(asset, ready[0])
+    return Markup('src="{0}" srcset="{1}" sizes="{2}" width="{3}" height="{4}" loading="lazy" decoding="async"').format(
+        url_for('static', filename=derivative_path(path, ready[0])), srcset, sizes, width, height
+    )
+
+@app.cli.command('build-image-derivatives')
+def build_image_derivatives_command():
+    uploads = [(media_path('trip_posts', post.image), POST_IMAGE_VARIANTS) for post in TripPost.query.all()]
+    uploads += [(media_path('profile_pics', user.profile_pic), AVATAR_VARIANTS) for user in User.query.filter(User.profile_pic.isnot(None))]
+    built = 0
+    for path, variants in uploads:
+        if not os.path.exists(os.path.join('static', path)):
+            continue
+        try:
+            build_image_derivatives(path, variants)
+            built += 1
+        except Exception as e:
+            db.session.rollback()
+            print(f"Skipped {path}: {e}")
+    print(f"Built derivatives for {built} of {len(uploads)} upload(s).")
+
+# --- Blob store: uploads are kept once per content hash and shared by reference count ---
+BLOB_FOLDER = 'static/blobs'
+BLOB_PREFIX = 'blobs/'
+BLOB_CHUNK_SIZE = 64 * 1024
+BLOB_ORPHAN_GRACE = timedelta(hours=1) # Unreferenced files younger than this may belong to an in-flight upload
+# (model, column, legacy folder under static/) for every column that stores an upload
+BLOB_REFERENCES = (
+    (TripPost, 'image', 'trip_posts'),
+    (User, 'profile_pic', 'profile_pics'),
+    (Message, 'attachment', 'profile_pics'),
+    (TripPhoto, 'filename', 'images/trip_gallery'),
+)
+
+# Path under static/ for a stored upload; names from before the blob store live in their old folder
+@app.template_global()
+def media_path(folder, name):
+    if not name or name.startswith(BLOB_PREFIX):
+        return name
+    return f"{folder}/{name}"
+
+def is_blob(name):
+    return bool(name) and name.startswith(BLOB_PREFIX)
+
+# --- Streaming uploads: hashed and size-checked chunk by chunk while the multipart body is parsed ---
+MB = 1024 * 1024
+UPLOAD_LIMITS = {'post': 15 * MB, 'avatar': 5 * MB, 'attachment': 25 * MB, 'gallery': 15 * MB}
+UPLOAD_ENDPOINTS = {'home': 'post', 'trip_posts': 'post', 'edit_profile': 'avatar', 'chat': 'attachment', 'trip_gallery': 'gallery'}
+UPLOAD_FORM_OVERHEAD = 64 * 1024 # Multipart headers and the text fields sent alongside the file
+app.config['MAX_CONTENT_LENGTH'] = max(UPLOAD_LIMITS.values()) + UPLOAD_FORM_OVERHEAD
+
+class UploadSpool:
+    # Writable temp file next to the blobs; the parser writes into it and it is renamed into place without a copy
+    def __init__(self, limit=None):
+        os.makedirs(BLOB_FOLDER, exist_ok=True)
+        fd, self.temp_path = tempfile.mkstemp(dir=BLOB_FOLDER, suffix='.part')
+        self.file = os.fdopen(fd, 'w+b')
+        self.digest = hashlib.sha256()
+        self.size = 0
+        self.limit = limit
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.limit is not None and self.size > self.limit:
+            raise RequestEntityTooLarge()
+        self.digest.update(chunk)
+        return self.file.write(chunk)
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+    def discard(self):
+        self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+class UploadRequest(Request):
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        kind = UPLOAD_ENDPOINTS.get(self.endpoint)
+        if not kind or not filename:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        spool = UploadSpool(UPLOAD_LIMITS[kind])
+        self.upload_spools = getattr(self, 'upload_spools', []) + [spool]
+        return spool
+
+app.request_class = UploadRequest
+
+@app.template_global()
+def upload_limit(kind):
+    return UPLOAD_LIMITS[kind]
+
+# A Content-Length over the endpoint's limit is refused before any of the body is read
+@app.before_request
+def limit_upload_size():
+    kind = UPLOAD_ENDPOINTS.get(request.endpoint)
+    if kind and request.method == 'POST':
+        request.max_content_length = UPLOAD_LIMITS[kind] + UPLOAD_FORM_OVERHEAD
+
+@app.teardown_request
+def discard_upload_spools(exc):
+    for spool in getattr(request, 'upload_spools', []):
+        spool.discard()
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    limit = UPLOAD_LIMITS.get(UPLOAD_ENDPOINTS.get(request.endpoint), app.config['MAX_CONTENT_LENGTH'])
+    message = f"File is too large (limit {limit // MB} MB)."
+    if request.headers.get('X-Upload-Progress') or request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({'success': False, 'error': message}), 413
+    flash(message, 'danger')
+    return redirect(request.url)
+
+# Progress uploads are sent over XHR; hand the redirect back so the page can follow it itself
+@app.after_request
+def upload_redirect_as_json(response):
+    if request.headers.get('X-Upload-Progress') and response.status_code in (301, 302, 303):
+        return jsonify({'success': True, 'redirect': response.location})
+    return response
+
+# Keep the first copy of each hash; returns (path, created). Uploads arrive already spooled and hashed.
+def store_blob(stream, filename):
+    ext = secure_filename(filename.rsplit('.', 1)[1].lower()) if '.' in filename else ''
+    spool = stream if isinstance(stream, UploadSpool) else UploadSpool()
+    try:
+        if spool is not stream:
+            for chunk in iter(lambda: stream.read(BLOB_CHUNK_SIZE), b''):
+                spool.write(chunk)
+        spool.file.close()
+        key = spool.digest.hexdigest()
+        existing = db.session.get(Blob, key)
+        path = existing.path if existing else f"{BLOB_PREFIX}{key[:2]}/{key}{'.' + ext if ext else ''}"
+        target = os.path.join('static', path)
+        created = not os.path.exists(target)
+        if created:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            os.replace(spool.temp_path, target)
+    finally:
+        spool.discard()
+    # Upsert so two uploads of the same bytes both count
+    blob_table = Blob.__table__
+    db.session.execute(
+        sqlite_insert(blob_table)
+        .values(hash=key, path=path, size=spool.size, ref_count=1, created_at=datetime.utcnow())
+        .on_conflict_do_update(index_elements=['hash'], set_={'ref_count': blob_table.c.ref_count + 1})
+    )
+    return path, created
+
+def store_upload(file, variants=None):
+    path, created = store_blob(file.stream, file.filename)
+    if variants:
+        asset = db.session.get(ImageAsset, path)
+        if created or not asset or not set(variants) <= set(asset.variants.split(',')):
+            queue_image_derivatives(path, variants)
+    return path
+
+# Drop one reference; files are only removed by gc-blobs once nothing points at them
+def release_blob(path):
+    if not is_blob(path):
+        return False
+    Blob.query.filter_by(path=path).update({Blob.ref_count: Blob.ref_count - 1}, synchronize_session=False)
+    return True
+
+@app.cli.command('migrate-uploads')
+def migrate_uploads_command():
+    moved, missing, legacy_paths = 0, 0, set()
+    for model, column, folder in BLOB_REFERENCES:
+        attr = getattr(model, column)
+        for row in model.query.filter(attr.isnot(None), attr != '', ~attr.startswith(BLOB_PREFIX)):
+            legacy = media_path(folder, getattr(row, column))
+            source = os.path.join('static', legacy)
+            if not os.path.exists(source):
+                missing += 1
+                continue
+            with open(source, 'rb') as f:
+                path, _ = store_blob(f, legacy)
+            setattr(row, column, path)
+            legacy_paths.add(legacy)
+            moved += 1
+    db.session.commit()
+    for legacy in legacy_paths:
+        os.remove(os.path.join('static', legacy))
+        remove_image_derivatives(legacy)
+    db.session.commit()
+    print(f"Moved {moved} upload(s) into the blob store ({len(legacy_paths)} file(s)); {missing} missing on disk.")
+    print("Run 'flask build-image-derivatives' to rebuild their variants.")
+
+@app.cli.command('gc-blobs')
+def gc_blobs_command():
+    # Recount from the referencing columns so a failed request cannot leak or over-release a blob
+    counts = {}
+    for model, column, _ in BLOB_REFERENCES:
+        attr = getattr(model, column)
+        for path, count in db.session.query(attr, db.func.count()).filter(attr.startswith(BLOB_PREFIX)).group_by(attr):
+            counts[path] = counts.get(path, 0) + count
+    fixed, removed = 0, 0
+    for blob in Blob.query.all():
+        count = counts.get(blob.path, 0)
+        if count:
+            if blob.ref_count != count:
+                blob.ref_count = count
+                fixed += 1
+            continue
+        target = os.path.join('static', blob.path)
+        if os.path.exists(target):
+            os.remove(target)
+        remove_image_derivatives(blob.path)
+        db.session.delete(blob)
+        removed += 1
+    db.session.commit()
+    # Files with no Blob row come from requests that rolled back after writing
+    known = {blob.path for blob in Blob.query.all()}
+    cutoff = time.time() - BLOB_ORPHAN_GRACE.total_seconds()
+    for root, _, files in os.walk(BLOB_FOLDER):
+        for name in files:
+            target = os.path.join(root, name)
+            if os.path.relpath(target, 'static').replace(os.sep, '/') not in known and os.path.getmtime(target) < cutoff:
+                os.remove(target)
+                removed += 1
+    print(f"Fixed {fixed} reference count(s), removed {removed} unreferenced file(s).")
+
 def register_user(username, password, bio, interests):
     if User.query.filter_by(username=username).first():
         return False  # User exists
@@ -250,33 +729,1013 @@ def check_login(username, password):
     user = User.query.filter_by(username=username).first()
     return user and user.password == password
 
-def get_next_trip_id():
-    last_trip = Trip.query.order_by(Trip.trip_id.desc()).first()
-    return (last_trip.trip_id + 1) if last_trip else 1
+# --- Schema upgrades: bring a database created by an older version up to the current models ---
+# create_all only creates missing tables; this also adds new columns, indexes and unique
+# constraints to existing ones, and is safe to run repeatedly. Upgrade order:
+#   flask upgrade-db && flask migrate-autoincrement, then the backfills
+#   (reconcile-post-counters, render-captions, reindex-captions, rebuild-timelines,
+#   backfill-notifications, rebuild-conversations, normalize-message-timestamps, migrate-uploads)
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    changes = []
+    with db.engine.begin() as conn:
+        inspector = db.inspect(conn)
+        existing_tables = set(inspector.get_table_names())
+        for table in db.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                table.create(conn)
+                changes.append(f"created table {table.name}")
+                continue
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in columns:
+                    # New columns are nullable or carry a server default, which SQLite's ADD COLUMN requires
+                    conn.execute(db.text(f'ALTER TABLE "{table.name}" ADD COLUMN {CreateColumn(column).compile(dialect=conn.dialect)}'))
+                    changes.append(f"added {table.name}.{column.name}")
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            indexes |= {constraint['name'] for constraint in inspector.get_unique_constraints(table.name)}
+            for constraint in table.constraints:
+                if not isinstance(constraint, db.UniqueConstraint) or not constraint.name or constraint.name in indexes:
+                    continue
+                # Rows written before the constraint may repeat; keep the oldest of each
+                (pk,) = table.primary_key.columns
+                keys = ', '.join(f'"{column.name}"' for column in constraint.columns)
+                removed = conn.execute(db.text(
+                    f'DELETE FROM "{table.name}" WHERE "{pk.name}" NOT IN '
+                    f'(SELECT MIN("{pk.name}") FROM "{table.name}" GROUP BY {keys})'
+                )).rowcount
+                conn.execute(db.text(f'CREATE UNIQUE INDEX "{constraint.name}" ON "{table.name}" ({keys})'))
+                changes.append(f"added unique {constraint.name}" + (f" (removed {removed} duplicate row(s))" if removed else ""))
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(conn)
+                    changes.append(f"added index {index.name}")
+    for change in changes:
+        print(change)
+    print(f"Schema is up to date ({len(changes)} change(s)).")
+
+# AUTOINCREMENT keeps IDs from being reused after deletes. Tables created before it was set
+# are rebuilt in place by migrate-autoincrement; rows keep their IDs.
+AUTOINCREMENT_MODELS = (Trip, Message, Review, Notification, Invitation, TripPhoto, Report)
+
+@app.cli.command('migrate-autoincrement')
+def migrate_autoincrement_command():
+    rebuilt = []
+    with db.engine.begin() as conn:
+        # Keep references in other tables pointing at the original name while it is swapped out
+        conn.execute(db.text('PRAGMA legacy_alter_table = ON'))
+        for model in AUTOINCREMENT_MODELS:
+            table = model.__table__
+            ddl = conn.execute(
+                db.text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {'name': table.name}
+            ).scalar()
+            if ddl is None or 'AUTOINCREMENT' in ddl.upper():
+                continue
+            legacy = f"{table.name}_legacy"
+            conn.execute(db.text(f'ALTER TABLE "{table.name}" RENAME TO "{legacy}"'))
+            indexes = conn.execute(
+                db.text("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :name AND sql IS NOT NULL"), {'name': legacy}
+            ).scalars().all()
+            for index in indexes:
+                conn.execute(db.text(f'DROP INDEX "{index}"'))
+            table.create(conn)
+            legacy_columns = {row[1] for row in conn.execute(db.text(f'PRAGMA table_info("{legacy}")'))}
+            columns = ', '.join(f'"{column.name}"' for column in table.columns if column.name in legacy_columns)
+            # Explicit IDs also advance sqlite_sequence, so new rows continue after the current maximum
+            conn.execute(db.text(f'INSERT INTO "{table.name}" ({columns}) SELECT {columns} FROM "{legacy}"'))
+            conn.execute(db.text(f'DROP TABLE "{legacy}"'))
+            rebuilt.append(table.name)
+        conn.execute(db.text('PRAGMA legacy_alter_table = OFF'))
+    print(f"Rebuilt with AUTOINCREMENT: {', '.join(rebuilt) or 'nothing to do'}.")
+
+# --- Fingerprinted static URLs: every url_for('static') carries a content hash, so files can be cached forever ---
+STATIC_IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+static_fingerprints = {} # {filename: (mtime, size, fingerprint)}
+
+def static_fingerprint(filename):
+    try:
+        stat = os.stat(os.path.join(app.static_folder, filename))
+    except OSError:
+        return None
+    cached = static_fingerprints.get(filename)
+    if cached and cached[:2] == (stat.st_mtime, stat.st_size):
+        return cached[2]
+    digest = hashlib.sha256()
+    with open(os.path.join(app.static_folder, filename), 'rb') as f:
+        for chunk in iter(lambda: f.read(BLOB_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    fingerprint = digest.hexdigest()[:12]
+    static_fingerprints[filename] = (stat.st_mtime, stat.st_size, fingerprint)
+    return fingerprint
+
+def is_content_addressed(filename):
+    # Blob paths and their derivatives already contain the content hash
+    return filename.startswith(BLOB_PREFIX) or filename.startswith('derivatives/' + BLOB_PREFIX)
+
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    if endpoint == 'static' and 'v' not in values and not is_content_addressed(values.get('filename', '')):
+        fingerprint = static_fingerprint(values.get('filename', ''))
+        if fingerprint:
+            values['v'] = fingerprint
+
+# send_from_directory already answers If-None-Match/If-Modified-Since with 304; only the lifetime changes
+@app.after_request
+def cache_fingerprinted_static(response):
+    if request.endpoint != 'static' or response.status_code not in (200, 304):
+        return response
+    filename = (request.view_args or {}).get('filename', '')
+    version = request.args.get('v')
+    if is_content_addressed(filename) or (version and version == static_fingerprint(filename)):
+        response.cache_control.public = True
+        response.cache_control.max_age = STATIC_IMMUTABLE_MAX_AGE
+        response.cache_control.immutable = True
+        response.cache_control.no_cache = None
+    return response
+
+SERVICE_WORKER_PRECACHE = ('manifest.json',)
+SERVICE_WORKER_PRECACHE_FOLDERS = ('css', 'icons')
+
+# Served from the root so its scope covers every page; the shell URLs and cache version are baked in per deploy
+@app.route('/service-worker.js')
+def service_worker():
+    shell = list(SERVICE_WORKER_PRECACHE) + sorted(
+        f"{folder}/{name}"
+        for folder in SERVICE_WORKER_PRECACHE_FOLDERS
+        for name in os.listdir(os.path.join(app.static_folder, folder))
+    )
+    precache = [url_for('static', filename=filename) for filename in shell]
+    version = hashlib.sha256(' '.join(precache).encode()).hexdigest()[:12]
+    with open(os.path.join(app.static_folder, 'service-worker.js'), encoding='utf-8') as f:
+        script = f.read()
+    prelude = f"const CACHE_VERSION = {json.dumps(version)};\nconst PRECACHE_URLS = {json.dumps(precache)};\n"
+    response = app.response_class(prelude + script, mimetype='application/javascript')
+    response.cache_control.no_cache = True
+    return response
+
+# --- User summaries: avatar and profile fields loaded in one IN query, memoized per request and in a process LRU ---
+# The LRU is per process; edit_profile invalidates it locally and the TTL bounds staleness elsewhere.
+USER_SUMMARY_CACHE_SIZE = 2048
+USER_SUMMARY_TTL = 300 # Seconds
+user_summary_cache = OrderedDict() # {username: (expires_at, summary)}, least recently used first
+user_summary_lock = threading.Lock()
+
+def build_user_summary(user):
+    avatar_path, avatar_ready = None, True
+    if user.profile_pic:
+        avatar_path = media_path('profile_pics', user.profile_pic)
+        asset = get_image_asset(avatar_path)
+        avatar_ready = bool(asset and 'avatar' in asset.variants.split(','))
+        if avatar_ready:
+            avatar_path = derivative_path(avatar_path, 'avatar')
+    return {'username': user.username, 'bio': user.bio, 'avatar_path': avatar_path}, avatar_ready
+
+def prefetch_user_summaries(usernames):
+    memo = g.setdefault('user_summaries', {})
+    missing = {username for username in usernames if username and username not in memo}
+    if not missing:
+        return
+    now = time.monotonic()
+    with user_summary_lock:
+        for username in list(missing):
+            entry = user_summary_cache.get(username)
+            if entry and entry[0] > now:
+                user_summary_cache.move_to_end(username)
+                memo[username] = entry[1]
+                missing.discard(username)
+    if not missing:
+        return
+    users = User.query.filter(User.username.in_(missing)).all()
+    prefetch_image_assets([media_path('profile_pics', user.profile_pic) for user in users if user.profile_pic])
+    fresh = {}
+    for user in users:
+        summary, cacheable = build_user_summary(user)
+        memo[user.username] = summary
+        # Avatars still waiting on their derivative stay request-local so the smaller image is picked up soon
+        if cacheable:
+            fresh[user.username] = summary
+    for username in missing - memo.keys():
+        memo[username] = fresh[username] = None
+    with user_summary_lock:
+        for username, summary in fresh.items():
+            user_summary_cache[username] = (now + USER_SUMMARY_TTL, summary)
+            user_summary_cache.move_to_end(username)
+        while len(user_summary_cache) > USER_SUMMARY_CACHE_SIZE:
+            user_summary_cache.popitem(last=False)
+
+def get_user_summary(username):
+    prefetch_user_summaries([username])
+    return g.user_summaries.get(username)
+
+def invalidate_user_summary(username):
+    with user_summary_lock:
+        user_summary_cache.pop(username, None)
+    g.get('user_summaries', {}).pop(username, None)
+
+# --- Feed hydration: liked-by-viewer and comments for a whole page of posts ---
+# Like and comment counts are read from the denormalized TripPost columns.
+COMMENT_PREVIEW_SIZE = 3
+COMMENT_PAGE_SIZE = 20
+
+def hydrate_posts(posts, viewer=None, comment_limit=COMMENT_PREVIEW_SIZE):
+    post_ids = [post.post_id for post in posts]
+    prefetch_image_assets([media_path('trip_posts', post.image) for post in posts])
+    liked_ids = set()
+    comments_by_post = {post_id: [] for post_id in post_ids}
+    if post_ids:
+        if viewer:
+            liked_ids = {
+                row.post_id for row in db.session.query(TripPostLike.post_id)
+                .filter(TripPostLike.post_id.in_(post_ids), TripPostLike.username == viewer)
+            }
+        # Only the newest comment_limit comments per post; older ones page in via /trip_post/<id>/comments
+        position = db.func.row_number().over(
+            partition_by=TripPostComment.post_id,
+            order_by=TripPostComment.id.desc()
+        ).label('position')
+        latest = (
+            db.session.query(TripPostComment.id, position)
+            .filter(TripPostComment.post_id.in_(post_ids))
+            .subquery()
+        )
+        comments = (
+            TripPostComment.query.join(latest, latest.c.id == TripPostComment.id)
+            .filter(latest.c.position <= comment_limit)
+            .order_by(TripPostComment.id.asc())
+            .all()
+        )
+        for comment in comments:
+            comments_by_post[comment.post_id].append(comment)
+    for post in posts:
+        buffered = buffered_like_state(post.post_id, viewer) if viewer else None
+        post.liked_by_user = buffered if buffered is not None else post.post_id in liked_ids
+        post.comments = comments_by_post.get(post.post_id, [])
+    prefetch_user_summaries(
+        {post.username for post in posts} | {comment.username for post in posts for comment in post.comments} | {viewer}
+    )
+    return posts
+
+def adjust_post_counter(post_id, column, delta):
+    # Increment in SQL so concurrent writers don't lose updates; caller commits
+    TripPost.query.filter_by(post_id=post_id).update({column: column + delta}, synchronize_session=False)
+
+@app.cli.command('reconcile-post-counters')
+def reconcile_post_counters():
+    # Duplicate likes predate the unique (post_id, username) constraint; keep the oldest of each
+    keep = db.session.query(db.func.min(TripPostLike.id)).group_by(TripPostLike.post_id, TripPostLike.username)
+    duplicates = TripPostLike.query.filter(~TripPostLike.id.in_(keep)).delete(synchronize_session=False)
+    if duplicates:
+        print(f"Removed {duplicates} duplicate like(s).")
+    like_counts = dict(
+        db.session.query(TripPostLike.post_id, db.func.count(TripPostLike.id))
+        .group_by(TripPostLike.post_id)
+        .all()
+    )
+    comment_counts = dict(
+        db.session.query(TripPostComment.post_id, db.func.count(TripPostComment.id))
+        .group_by(TripPostComment.post_id)
+        .all()
+    )
+    fixes = []
+    for post_id, like_count, comment_count in db.session.query(TripPost.post_id, TripPost.like_count, TripPost.comment_count):
+        actual_likes = like_counts.get(post_id, 0)
+        actual_comments = comment_counts.get(post_id, 0)
+        if like_count != actual_likes or comment_count != actual_comments:
+            print(f"Post {post_id}: likes {like_count} -> {actual_likes}, comments {comment_count} -> {actual_comments}")
+            fixes.append({'post_id': post_id, 'like_count': actual_likes, 'comment_count': actual_comments})
+    if fixes:
+        db.session.bulk_update_mappings(TripPost, fixes)
+        db.session.commit()
+    print(f"Reconciled post counters: {len(fixes)} post(s) had drifted.")
+
+# --- Write-behind like buffer ---
+# Toggles are merged per (post_id, username) in memory and written in one transaction
+# every LIKE_FLUSH_SECONDS. Each entry is (liked, baseline), where baseline is what the
+# database holds (or will hold once the in-flight batch lands), so a like followed by an
+# unlike before the flush cancels out without touching the database.
+LIKE_FLUSH_SECONDS = 1.0
+pending_likes = {}
+inflight_likes = {}
+pending_likes_lock = threading.Lock()
+like_flusher = {'started': False}
+
+def buffered_like_state(post_id, username):
+    key = (post_id, username)
+    with pending_likes_lock:
+        entry = pending_likes.get(key) or inflight_likes.get(key)
+    return entry[0] if entry else None
+
+def buffered_like_delta(post_id):
+    with pending_likes_lock:
+        entries = list(inflight_likes.items()) + list(pending_likes.items())
+    return sum(int(liked) - int(baseline) for (entry_post_id, _), (liked, baseline) in entries if entry_post_id == post_id)
+
+def toggle_like(post_id, username):
+    key = (post_id, username)
+    liked = buffered_like_state(post_id, username)
+    if liked is None:
+        liked = TripPostLike.query.filter_by(post_id=post_id, username=username).first() is not None
+    with pending_likes_lock:
+        if key in pending_likes:
+            baseline = pending_likes[key][1]
+        elif key in inflight_likes:
+            baseline = inflight_likes[key][0]
+        else:
+            baseline = liked
+        if (not liked) == baseline:
+            pending_likes.pop(key, None)
+        else:
+            pending_likes[key] = (not liked, baseline)
+    start_like_flusher()
+    return not liked
+
+def flush_pending_likes():
+    with pending_likes_lock:
+        if not pending_likes:
+            return
+        inflight_likes.update(pending_likes)
+        pending_likes.clear()
+        batch = dict(inflight_likes)
+    try:
+        with app.app_context():
+            post_ids = {post_id for post_id, _ in batch}
+            authors = dict(db.session.query(TripPost.post_id, TripPost.username).filter(TripPost.post_id.in_(post_ids)))
+            likes = [key for key, (liked, baseline) in batch.items() if liked and not baseline and key[0] in authors]
+            unlikes = [key for key, (liked, baseline) in batch.items() if not liked and baseline]
+            if likes:
+                db.session.execute(
+                    sqlite_insert(TripPostLike.__table__)
+                    .values([{'post_id': post_id, 'username': username} for post_id, username in likes])
+                    .on_conflict_do_nothing()
+                )
+            for post_id, username in unlikes:
+                TripPostLike.query.filter_by(post_id=post_id, username=username).delete(synchronize_session=False)
+            # Recount touched posts from the rows so the counter stays right even when another worker raced us
+            like_rows = db.session.query(db.func.count(TripPostLike.id)).filter(TripPostLike.post_id == TripPost.post_id).scalar_subquery()
+            TripPost.query.filter(TripPost.post_id.in_(authors)).update({TripPost.like_count: like_rows}, synchronize_session=False)
+            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            notifications = [
+                add_notification(authors[post_id], 'like', f"{username} liked your post.", timestamp, actor=username, post_id=post_id)
+                for post_id, username in likes if authors[post_id] != username
+            ]
+            db.session.commit()
+            push_notifications(notifications)
+    except Exception:
+        # Nothing landed: put the batch back, keeping any toggle made since but with the real baseline
+        with pending_likes_lock:
+            for key, (liked, baseline) in batch.items():
+                newer = pending_likes.get(key)
+                if newer is None:
+                    pending_likes[key] = (liked, baseline)
+                elif newer[0] == baseline:
+                    del pending_likes[key]
+                else:
+                    pending_likes[key] = (newer[0], baseline)
+        raise
+    finally:
+        with pending_likes_lock:
+            inflight_likes.clear()
+
+def run_like_flusher(sleep):
+    while True:
+        sleep(LIKE_FLUSH_SECONDS)
+        try:
+            flush_pending_likes()
+        except Exception as e:
+            print(f"[LikeBuffer] flush failed: {e}")
+
+def start_like_flusher():
+    if like_flusher['started']:
+        return
+    with pending_likes_lock:
+        if like_flusher['started']:
+            return
+        like_flusher['started'] = True
+    # Under the eventlet server, notification emits only reach clients from a green task. Other
+    # servers (gunicorn's sync workers in Profile) never run the hub, so they get a real thread.
+    if has_request_context() and 'eventlet.input' in request.environ:
+        socketio.start_background_task(run_like_flusher, socketio.sleep)
+    else:
+        threading.Thread(target=run_like_flusher, args=(time.sleep,), daemon=True).start()
+
+atexit.register(flush_pending_likes)
+
+# --- Presence: heartbeats kept in memory, last_seen written in one UPDATE every PRESENCE_FLUSH_SECONDS ---
+# Each process tracks the users it served; users it has not seen fall back to the stored last_seen,
+# which lags by at most one flush interval.
+PRESENCE_FLUSH_SECONDS = 30
+ONLINE_WINDOW = timedelta(minutes=2)
+presence_heartbeats = {} # {username: last request time (UTC)}
+dirty_presence = set()
+presence_lock = threading.Lock()
+presence_flusher = {'started': False}
+
+def record_heartbeat(username):
+    with presence_lock:
+        presence_heartbeats[username] = datetime.utcnow()
+        dirty_presence.add(username)
+    start_presence_flusher()
+
+def presence_snapshot(usernames):
+    usernames = set(usernames)
+    with presence_lock:
+        seen = {username: presence_heartbeats[username] for username in usernames if username in presence_heartbeats}
+    missing = usernames - seen.keys()
+    if missing:
+        seen.update(db.session.query(User.username, User.last_seen).filter(User.username.in_(missing)))
+    return {username: seen.get(username) for username in usernames}
+
+def is_online_at(last_seen, now=None):
+    return bool(last_seen) and (now or datetime.utcnow()) - last_seen < ONLINE_WINDOW
+
+def flush_presence():
+    with presence_lock:
+        batch = {username: presence_heartbeats[username] for username in dirty_presence}
+        dirty_presence.clear()
+    if not batch:
+        return
+    with app.app_context():
+        User.query.filter(User.username.in_(batch)).update(
+            {User.last_seen: db.case(batch, value=User.username, else_=User.last_seen)}, synchronize_session=False
+        )
+        db.session.commit()
+
+def run_presence_flusher():
+    while True:
+        time.sleep(PRESENCE_FLUSH_SECONDS)
+        try:
+            flush_presence()
+        except Exception as e:
+            print(f"[Presence] flush failed: {e}")
+
+def start_presence_flusher():
+    if presence_flusher['started']:
+        return
+    with presence_lock:
+        if presence_flusher['started']:
+            return
+        presence_flusher['started'] = True
+    threading.Thread(target=run_presence_flusher, daemon=True).start()
+
+atexit.register(flush_presence)
+
+# --- Notifications: unread counter persisted on User, mirrored in memory, new items pushed over Socket.IO ---
+UNREAD_COUNT_TTL = 60 # Seconds before another process's writes are picked up
+unread_counts = {} # {username: (expires_at, count)}
+unread_counts_lock = threading.Lock()
+
+def notification_room(username):
+    return f"user:{username}"
+
+# Caller commits, then hands the result to push_notifications
+# Repeated events on the same target fold into the newest unread row within the window
+NOTIFICATION_AGGREGATE_WINDOW = timedelta(hours=24)
+AGGREGATED_NOTIFICATIONS = {'like': 'liked your post.', 'comment': 'commented on your post.', 'follow': 'started following you.'}
+app.config['NOTIFICATION_RETENTION_DAYS'] = 30
+
+def aggregate_message(type, actor, actor_count):
+    if actor_count <= 1:
+        return f"{actor} {AGGREGATED_NOTIFICATIONS[type]}"
+    others = actor_count - 1
+    return f"{actor} and {others} other{'s' if others > 1 else ''} {AGGREGATED_NOTIFICATIONS[type]}"
+
+# Returns True when actor had not contributed to the notification yet
+def add_notification_actor(notification_id, actor):
+    result = db.session.execute(
+        sqlite_insert(NotificationActor.__table__)
+        .values(notification_id=notification_id, username=actor)
+        .on_conflict_do_nothing()
+    )
+    return result.rowcount == 1
+
+def add_notification(username, type, message, timestamp=None, actor=None, trip_id=None, invitation_id=None, post_id=None):
+    timestamp = timestamp or datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    if type in AGGREGATED_NOTIFICATIONS and actor:
+        cutoff = (datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S') - NOTIFICATION_AGGREGATE_WINDOW).strftime('%Y-%m-%d %H:%M:%S')
+        existing = (
+            Notification.query.filter_by(username=username, type=type, post_id=post_id, is_read=0)
+            .filter(Notification.timestamp >= cutoff)
+            .order_by(Notification.notification_id.desc()).first()
+        )
+        if existing:
+            # Unread already, so the counter stays as it is. Rows folded before actors were
+            # recorded only know their latest actor; seed it so they are not counted twice.
+            if existing.actor:
+                add_notification_actor(existing.notification_id, existing.actor)
+            if add_notification_actor(existing.notification_id, actor):
+                existing.actor_count += 1
+            existing.actor = actor
+            existing.message = aggregate_message(type, actor, existing.actor_count)
+            existing.timestamp = timestamp
+            return existing
+    notification = Notification(username, type, message, 0, timestamp, actor, trip_id, invitation_id, post_id)
+    notification.is_new = True
+    db.session.add(notification)
+    if type in AGGREGATED_NOTIFICATIONS and actor:
+        db.session.flush()
+        add_notification_actor(notification.notification_id, actor)
+    User.query.filter_by(username=username).update(
+        {User.unread_notifications: User.unread_notifications + 1}, synchronize_session=False
+    )
+    return notification
+
+def get_unread_count(username):
+    now = time.monotonic()
+    with unread_counts_lock:
+        entry = unread_counts.get(username)
+    if entry and entry[0] > now:
+        return entry[1]
+    count = db.session.query(User.unread_notifications).filter_by(username=username).scalar() or 0
+    with unread_counts_lock:
+        unread_counts[username] = (now + UNREAD_COUNT_TTL, count)
+    return count
+
+def set_unread_count(username, count):
+    with unread_counts_lock:
+        unread_counts[username] = (time.monotonic() + UNREAD_COUNT_TTL, count)
+
+def push_notifications(notifications):
+    # A batch can touch the same aggregated row more than once; push it once
+    for notification in dict.fromkeys(notifications):
+        username = notification.username
+        with unread_counts_lock:
+            entry = unread_counts.get(username)
+            if entry and getattr(notification, 'is_new', False):
+                unread_counts[username] = (entry[0], entry[1] + 1)
+        socketio.emit('notification', {
+            'id': notification.notification_id,
+            'type': notification.type,
+            'message': notification.message,
+            'actor_count': notification.actor_count,
+            'timestamp': notification.timestamp,
+            'unread_count': get_unread_count(username),
+        }, to=notification_room(username))
+
+@app.template_global()
+def unread_notification_count():
+    return get_unread_count(session['username']) if 'username' in session else 0
+
+@app.cli.command('compact-notifications')
+@click.option('--days', type=int, default=None, help='Age in days; defaults to NOTIFICATION_RETENTION_DAYS.')
+def compact_notifications_command(days):
+    # Old read likes, comments and follows collapse to one row per target; invites keep their rows for the invitation state
+    days = days if days is not None else app.config['NOTIFICATION_RETENTION_DAYS']
+    cutoff = (datetime.now() - timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
+    old = (
+        Notification.query.filter(
+            Notification.is_read == 1,
+            Notification.timestamp < cutoff,
+            Notification.type.in_(AGGREGATED_NOTIFICATIONS),
+        )
+        .order_by(Notification.notification_id.desc()).all()
+    )
+    groups = {}
+    for notif in old:
+        groups.setdefault((notif.username, notif.type, notif.post_id), []).append(notif)
+    removed = 0
+    for (_, type, _), rows in groups.items():
+        if len(rows) < 2:
+            continue
+        keep = rows[0]
+        ids = [row.notification_id for row in rows]
+        # Each actor counts once across the group, however many of its rows they appear in
+        actors = {username for (username,) in db.session.query(NotificationActor.username).filter(NotificationActor.notification_id.in_(ids))}
+        actors |= {row.actor for row in rows if row.actor}
+        NotificationActor.query.filter(NotificationActor.notification_id.in_(ids[1:])).delete(synchronize_session=False)
+        for actor in actors:
+            add_notification_actor(keep.notification_id, actor)
+        keep.actor_count = max(len(actors), 1)
+        keep.timestamp = max(row.timestamp for row in rows)
+        if keep.actor:
+            keep.message = aggregate_message(type, keep.actor, keep.actor_count)
+        Notification.query.filter(Notification.notification_id.in_(ids[1:])).delete(synchronize_session=False)
+        removed += len(rows) - 1
+    db.session.commit()
+    print(f"Compacted {removed} read notification(s) older than {days} day(s) into {sum(len(rows) > 1 for rows in groups.values())} row(s).")
+
+@app.cli.command('reconcile-unread-counts')
+def reconcile_unread_counts_command():
+    unread = (
+        db.session.query(db.func.count(Notification.notification_id))
+        .filter(Notification.username == User.username, Notification.is_read == 0)
+        .scalar_subquery()
+    )
+    fixed = User.query.filter(User.unread_notifications != unread).update(
+        {User.unread_notifications: unread}, synchronize_session=False
+    )
+    db.session.commit()
+    print(f"Fixed {fixed} unread counter(s).")
+
+# --- Conversation summaries: one row per (username, partner), kept in step with Message ---
+# Caller adds the message and commits; both run in the caller's transaction
+def record_message(message):
+    db.session.flush()
+    rows = [{
+        'username': message.sender, 'partner': message.receiver, 'unread_count': 0,
+    }]
+    if message.receiver != message.sender:
+        rows.append({'username': message.receiver, 'partner': message.sender, 'unread_count': 1})
+    for row in rows:
+        row.update(
+            last_message_id=message.message_id,
+            last_sender=message.sender,
+            last_message=message.content,
+            last_timestamp=str(message.timestamp),
+        )
+    stmt = sqlite_insert(Conversation.__table__).values(rows)
+    db.session.execute(stmt.on_conflict_do_update(
+        index_elements=['username', 'partner'],
+        set_={
+            'last_message_id': stmt.excluded.last_message_id,
+            'last_sender': stmt.excluded.last_sender,
+            'last_message': stmt.excluded.last_message,
+            'last_timestamp': stmt.excluded.last_timestamp,
+            'unread_count': Conversation.__table__.c.unread_count + stmt.excluded.unread_count,
+        },
+    ))
+
+def mark_conversation_read(username, partner=None):
+    # partner=None marks everything addressed to username, as the inbox does
+    messages = Message.query.filter(Message.receiver == username, Message.is_read == 0)
+    conversations = Conversation.query.filter(Conversation.username == username, Conversation.unread_count > 0)
+    if partner is not None:
+        messages = messages.filter(Message.sender == partner)
+        conversations = conversations.filter(Conversation.partner == partner)
+    messages.update({Message.is_read: 1}, synchronize_session=False)
+    conversations.update({Conversation.unread_count: 0}, synchronize_session=False)
+
+def conversation_summaries(username):
+    return Conversation.query.filter_by(username=username).order_by(Conversation.last_message_id.desc()).all()
+
+def conversation_preview(conversation):
+    if not conversation.last_timestamp:
+        return ""
+    return f"{conversation.last_message} · {conversation.last_timestamp}"
+
+# Chat sidebar: the user's conversations newest first, keyset-paginated on last_message_id
+SIDEBAR_PAGE_SIZE = 30
+
+def paginate_conversations(username, cursor=None, exclude=None, limit=SIDEBAR_PAGE_SIZE):
+    query = Conversation.query.filter(Conversation.username == username, Conversation.partner != username)
+    if exclude:
+        query = query.filter(Conversation.partner != exclude)
+    if cursor:
+        try:
+            query = query.filter(Conversation.last_message_id < int(cursor))
+        except ValueError:
+            pass
+    rows = query.order_by(Conversation.last_message_id.desc()).limit(limit + 1).all()
+    next_cursor = rows[limit - 1].last_message_id if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def sidebar_entries(username, rows):
+    partners = {row.partner for row in rows}
+    prefetch_user_summaries(partners | {username})
+    last_seen_by_user = presence_snapshot(partners)
+    now = datetime.utcnow()
+    return [{
+        'username': row.partner,
+        'avatar_url': get_avatar_url(row.partner),
+        'last_message': conversation_preview(row),
+        'unread': row.unread_count > 0,
+        'is_online': is_online_at(last_seen_by_user[row.partner], now),
+    } for row in rows]
+
+@app.cli.command('rebuild-conversations')
+def rebuild_conversations():
+    Conversation.query.delete()
+    latest = {}
+    unread = {}
+    for message in Message.query.order_by(Message.message_id):
+        latest[(message.sender, message.receiver)] = message
+        if message.receiver != message.sender:
+            latest[(message.receiver, message.sender)] = message
+            if not message.is_read:
+                unread[(message.receiver, message.sender)] = unread.get((message.receiver, message.sender), 0) + 1
+    db.session.add_all([
+        Conversation(username, partner, message.message_id, message.sender, message.content, str(message.timestamp), unread.get((username, partner), 0))
+        for (username, partner), message in latest.items()
+    ])
+    db.session.commit()
+    print(f"Rebuilt {len(latest)} conversation summary row(s).")
+
+# Legacy rows come in two shapes: str(datetime.utcnow()) with microseconds from the old chat page (already UTC),
+# and '%Y-%m-%d %H:%M:%S' from the old send_message, which used the server's local clock. The latter are
+# converted from --legacy-tz, defaulting to this machine's zone, so run it where the app used to run.
+@app.cli.command('normalize-message-timestamps')
+@click.option('--legacy-tz', default=None, help="Zone of second-precision legacy timestamps, e.g. 'Europe/Berlin'; defaults to the local zone.")
+def normalize_message_timestamps(legacy_tz):
+    legacy_zone = ZoneInfo(legacy_tz) if legacy_tz else None
+    normalized, unparsed = 0, 0
+    for message in Message.query.filter(Message.sent_at.is_(None)).order_by(Message.message_id):
+        sent_at = parse_message_timestamp(message.timestamp)
+        if sent_at is None:
+            unparsed += 1
+            continue
+        if '.' not in str(message.timestamp):
+            # naive.astimezone() reads the value as local time
+            local = sent_at.replace(tzinfo=legacy_zone) if legacy_zone else sent_at.astimezone()
+            sent_at = local.astimezone(timezone.utc).replace(tzinfo=None)
+        message.sent_at = sent_at
+        message.timestamp = sent_at.strftime(MESSAGE_TIMESTAMP_FORMAT)
+        normalized += 1
+    # Summaries copy the display string
+    Conversation.query.update(
+        {Conversation.last_timestamp: db.session.query(Message.timestamp).filter(Message.message_id == Conversation.last_message_id).scalar_subquery()},
+        synchronize_session=False
+    )
+    db.session.commit()
+    print(f"Normalized {normalized} message timestamp(s); {unparsed} could not be parsed.")
+
+# Chat history: newest page first, older pages keyed on message_id
+CHAT_PAGE_SIZE = 50
+
+def conversation_messages(user, other):
+    return Message.query.filter(
+        ((Message.sender == user) & (Message.receiver == other)) |
+        ((Message.sender == other) & (Message.receiver == user))
+    )
 
-def get_next_message_id():
-    last_message = Message.query.order_by(Message.message_id.desc()).first()
-    return (last_message.message_id + 1) if last_message else 1
+def paginate_chat_messages(user, other, before=None, limit=CHAT_PAGE_SIZE):
+    query = conversation_messages(user, other)
+    if before:
+        query = query.filter(Message.message_id < before)
+    messages = query.order_by(Message.message_id.desc()).limit(limit + 1).all()
+    older_cursor = messages[limit - 1].message_id if len(messages) > limit else None
+    return messages[:limit][::-1], older_cursor
+
+# --- Home timeline: fan-out on write along the Follow graph ---
+TIMELINE_INLINE_FANOUT = 200   # Followers written inside the request; larger audiences go to the pool
+TIMELINE_FANOUT_BATCH = 500
+TIMELINE_BACKFILL = 50         # Recent posts copied into a timeline on follow
+
+# A follow backfill can race the fan-out into the same timeline; whichever lands second skips the row
+def insert_timeline_entries(rows):
+    if rows:
+        db.session.execute(sqlite_insert(TimelineEntry.__table__).values(rows).on_conflict_do_nothing())
+
+def write_timeline_entries(post_id, author, timestamp, followers):
+    insert_timeline_entries([
+        {'username': follower, 'post_id': post_id, 'author': author, 'timestamp': timestamp}
+        for follower in followers
+    ])
 
-def get_next_review_id():
-    last_review = Review.query.order_by(Review.review_id.desc()).first()
-    return (last_review.review_id + 1) if last_review else 1
+def fan_out_in_background(post_id, author, timestamp, followers):
+    try:
+        with app.app_context():
+            for start in range(0, len(followers), TIMELINE_FANOUT_BATCH):
+                write_timeline_entries(post_id, author, timestamp, followers[start:start + TIMELINE_FANOUT_BATCH])
+                db.session.commit()
+    except Exception as e:
+        print(f"[Timeline] fan-out of post {post_id} to {len(followers)} follower(s) failed: {e}")
+
+# Call after the post is committed so background workers can see it
+def fan_out_post(post):
+    followers = [row.follower for row in db.session.query(Follow.follower).filter_by(followed=post.username)]
+    if len(followers) <= TIMELINE_INLINE_FANOUT:
+        write_timeline_entries(post.post_id, post.username, post.timestamp, followers)
+        db.session.commit()
+    else:
+        background_executor.submit(fan_out_in_background, post.post_id, post.username, post.timestamp, followers)
+
+def backfill_timeline(follower, followed):
+    existing = db.session.query(TimelineEntry.post_id).filter_by(username=follower, author=followed)
+    recent = (
+        db.session.query(TripPost.post_id, TripPost.timestamp)
+        .filter(TripPost.username == followed, ~TripPost.post_id.in_(existing))
+        .order_by(TripPost.timestamp.desc())
+        .limit(TIMELINE_BACKFILL)
+        .all()
+    )
+    insert_timeline_entries([
+        {'username': follower, 'post_id': post_id, 'author': followed, 'timestamp': timestamp}
+        for post_id, timestamp in recent
+    ])
 
-def get_next_notification_id():
-    last_notification = Notification.query.order_by(Notification.notification_id.desc()).first()
-    return (last_notification.notification_id + 1) if last_notification else 1
+def prune_timeline(follower, followed):
+    TimelineEntry.query.filter_by(username=follower, author=followed).delete(synchronize_session=False)
 
-def get_next_invitation_id():
-    last_invitation = Invitation.query.order_by(Invitation.invitation_id.desc()).first()
-    return (last_invitation.invitation_id + 1) if last_invitation else 1
+@app.cli.command('rebuild-timelines')
+def rebuild_timelines():
+    TimelineEntry.query.delete()
+    follows = db.session.query(Follow.follower, Follow.followed).distinct().all()
+    for follower, followed in follows:
+        backfill_timeline(follower, followed)
+    db.session.commit()
+    print(f"Rebuilt timelines from {len(follows)} follow(s).")
 
-def get_next_photo_id():
-    last_photo = TripPhoto.query.order_by(TripPhoto.photo_id.desc()).first()
-    return (last_photo.photo_id + 1) if last_photo else 1
+# --- Hashtag and mention index, maintained whenever a caption is written ---
+HASHTAG_RE = re.compile(r'#(\w+)')
+MENTION_RE = re.compile(r'@(\w+)')
+TRENDING_WINDOW_HOURS = 24
+TRENDING_LIMIT = 10
 
-def get_next_report_id():
-    last_report = Report.query.order_by(Report.report_id.desc()).first()
-    return (last_report.report_id + 1) if last_report else 1
+TAG_OR_MENTION_RE = re.compile(r'([#@])(\w+)')
+TAG_LINK = Markup('<a href="/hashtag/{0}" class="text-primary">#{0}</a>')
+MENTION_LINK = Markup('<a href="/user/{0}" class="text-success">@{0}</a>')
+
+# Escapes the text and links #tags and @mentions; stored next to the raw text on write
+def render_tags_and_mentions(text):
+    if not text:
+        return ''
+    parts = []
+    last = 0
+    for match in TAG_OR_MENTION_RE.finditer(text):
+        sigil, word = match.groups()
+        parts.append(escape(text[last:match.start()]))
+        parts.append((TAG_LINK if sigil == '#' else MENTION_LINK).format(word))
+        last = match.end()
+    parts.append(escape(text[last:]))
+    return str(Markup('').join(parts))
+
+@app.cli.command('render-captions')
+def render_captions():
+    posts = 0
+    for post in TripPost.query.filter(TripPost.caption_html.is_(None)).yield_per(500):
+        post.caption_html = render_tags_and_mentions(post.caption)
+        posts += 1
+    comments = 0
+    for comment in TripPostComment.query.filter(TripPostComment.comment_html.is_(None)).yield_per(500):
+        comment.comment_html = render_tags_and_mentions(comment.comment)
+        comments += 1
+    db.session.commit()
+    print(f"Rendered markup for {posts} caption(s) and {comments} comment(s).")
+
+def parse_caption(caption):
+    tags = {tag.lower() for tag in HASHTAG_RE.findall(caption or '')}
+    mentions = set(MENTION_RE.findall(caption or ''))
+    return tags, mentions
+
+def bump_hashtag_counts(tags, when):
+    bucket = when.replace(minute=0, second=0, microsecond=0)
+    for tag in tags:
+        # Rows are summed when read, so a duplicate from a racing insert is harmless
+        updated = HashtagCount.query.filter_by(tag=tag, bucket=bucket).update({HashtagCount.count: HashtagCount.count + 1}, synchronize_session=False)
+        if not updated:
+            db.session.add(HashtagCount(tag, bucket, 1))
+
+# Post must be flushed so it has an id; caller commits
+def index_post_caption(post, count_new_tags=True):
+    tags, mentions = parse_caption(post.caption)
+    old_tags = {row.tag for row in db.session.query(PostHashtag.tag).filter_by(post_id=post.post_id)}
+    old_mentions = {row.username for row in db.session.query(PostMention.username).filter_by(post_id=post.post_id)}
+    if old_tags - tags:
+        PostHashtag.query.filter(PostHashtag.post_id == post.post_id, PostHashtag.tag.in_(old_tags - tags)).delete(synchronize_session=False)
+    if old_mentions - mentions:
+        PostMention.query.filter(PostMention.post_id == post.post_id, PostMention.username.in_(old_mentions - mentions)).delete(synchronize_session=False)
+    db.session.add_all([PostHashtag(tag, post.post_id, post.timestamp) for tag in tags - old_tags])
+    db.session.add_all([PostMention(username, post.post_id, post.timestamp) for username in mentions - old_mentions])
+    if count_new_tags:
+        bump_hashtag_counts(tags - old_tags, datetime.utcnow())
+
+def unindex_post(post_id):
+    PostHashtag.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+    PostMention.query.filter_by(post_id=post_id).delete(synchronize_session=False)
+
+@app.cli.command('reindex-captions')
+def reindex_captions():
+    PostHashtag.query.delete()
+    PostMention.query.delete()
+    posts = TripPost.query.all()
+    for post in posts:
+        index_post_caption(post, count_new_tags=False)
+    db.session.commit()
+    print(f"Indexed hashtags and mentions for {len(posts)} post(s).")
+
+# --- Keyset pagination for feeds, ordered by (timestamp, post_id) newest first ---
+FEED_PAGE_SIZE = 20
+FEED_CARD_TEMPLATES = {
+    'home': 'home_post_card.html',
+    'trip_posts': 'trip_post_card.html',
+    'explore': 'explore_post_card.html',
+    'hashtag': 'explore_post_card.html',
+}
+
+def encode_feed_cursor(post):
+    return f"{post.timestamp.isoformat()}_{post.post_id}"
+
+def decode_feed_cursor(cursor):
+    try:
+        timestamp, post_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(timestamp), int(post_id)
+    except (AttributeError, ValueError):
+        return None
+
+# Returns the base query for a feed and the (timestamp, post_id) columns it is paginated on
+def feed_query(feed, viewer=None, tag=None):
+    if feed == 'home' and viewer:
+        query = TripPost.query.join(TimelineEntry, TimelineEntry.post_id == TripPost.post_id).filter(TimelineEntry.username == viewer)
+        return query, (TimelineEntry.timestamp, TimelineEntry.post_id)
+    if feed == 'hashtag':
+        query = TripPost.query.join(PostHashtag, PostHashtag.post_id == TripPost.post_id).filter(PostHashtag.tag == (tag or '').lower())
+        return query, (PostHashtag.timestamp, PostHashtag.post_id)
+    return TripPost.query, (TripPost.timestamp, TripPost.post_id)
+
+def paginate_posts(query, cursor=None, keys=(TripPost.timestamp, TripPost.post_id), limit=FEED_PAGE_SIZE):
+    timestamp_col, id_col = keys
+    position = decode_feed_cursor(cursor) if cursor else None
+    if position:
+        timestamp, post_id = position
+        query = query.filter(db.or_(
+            timestamp_col < timestamp,
+            db.and_(timestamp_col == timestamp, id_col < post_id)
+        ))
+    posts = query.order_by(timestamp_col.desc(), id_col.desc()).limit(limit + 1).all()
+    next_cursor = encode_feed_cursor(posts[limit - 1]) if len(posts) > limit else None
+    return posts[:limit], next_cursor
+
+def paginate_feed(feed, viewer=None, tag=None, cursor=None):
+    if feed == 'explore':
+        schedule_explore_refresh()
+        return paginate_explore(cursor)
+    query, keys = feed_query(feed, viewer, tag)
+    return paginate_posts(query, cursor, keys)
+
+# --- Explore ranking: scored in pandas batches, stored as a ranked snapshot ---
+EXPLORE_REFRESH_SECONDS = 300
+EXPLORE_WINDOW_DAYS = 30
+EXPLORE_SCORE_BATCH = 5000
+EXPLORE_GRAVITY = 1.5
+explore_state = {'refreshed_at': 0.0}
+explore_refresh_lock = threading.Lock()
+
+def compute_explore_scores(frame, now):
+    age_hours = (now - frame['timestamp']).dt.total_seconds().clip(lower=0) / 3600
+    engagement = frame['like_count'] + 2 * frame['comment_count']
+    return (engagement + 1) / (age_hours + 2) ** EXPLORE_GRAVITY
+
+def refresh_explore_scores():
+    # Posts are stamped with local time by the upload routes, so age is measured the same way
+    now = datetime.now()
+    query = db.session.query(TripPost.post_id, TripPost.timestamp, TripPost.like_count, TripPost.comment_count).filter(
+        TripPost.timestamp >= now - timedelta(days=EXPLORE_WINDOW_DAYS)
+    )
+    frames = []
+    with db.engine.connect() as conn:
+        for chunk in pd.read_sql(query.statement, conn, chunksize=EXPLORE_SCORE_BATCH, parse_dates=['timestamp']):
+            chunk['score'] = compute_explore_scores(chunk, now)
+            frames.append(chunk[['post_id', 'score']])
+    scores = pd.concat(frames) if frames else pd.DataFrame({'post_id': [], 'score': []})
+    scores = scores.sort_values(['score', 'post_id'], ascending=False)
+    PostScore.query.delete()
+    db.session.bulk_insert_mappings(PostScore, [
+        {'post_id': int(row.post_id), 'score': float(row.score), 'rank': rank, 'computed_at': now}
+        for rank, row in enumerate(scores.itertuples(index=False), start=1)
+    ])
+    db.session.commit()
+    explore_state['refreshed_at'] = time.time()
+    return len(scores)
+
+def run_explore_refresh():
+    try:
+        with app.app_context():
+            refresh_explore_scores()
+    except Exception as e:
+        print(f"[Explore] refresh failed: {e}")
+    finally:
+        explore_refresh_lock.release()
+
+def schedule_explore_refresh():
+    if time.time() - explore_state['refreshed_at'] < EXPLORE_REFRESH_SECONDS:
+        return
+    if not explore_refresh_lock.acquire(blocking=False):
+        return
+    explore_state['refreshed_at'] = time.time()
+    background_executor.submit(run_explore_refresh)
+
+def paginate_explore(cursor=None, limit=FEED_PAGE_SIZE):
+    after_rank = int(cursor) if cursor and cursor.isdigit() else 0
+    rows = (
+        db.session.query(TripPost, PostScore.rank)
+        .join(PostScore, PostScore.post_id == TripPost.post_id)
+        .filter(PostScore.rank > after_rank)
+        .order_by(PostScore.rank)
+        .limit(limit + 1)
+        .all()
+    )
+    if not rows and not after_rank:
+        # No snapshot yet (fresh database): show the newest posts until the first refresh lands
+        posts, _ = paginate_posts(TripPost.query, limit=limit)
+        return posts, None
+    next_cursor = str(rows[limit - 1][1]) if len(rows) > limit else None
+    return [post for post, _ in rows[:limit]], next_cursor
+
+@app.cli.command('refresh-explore')
+def refresh_explore_command():
+    print(f"Ranked {refresh_explore_scores()} post(s) for explore.")
+
+def post_to_dict(post):
+    return {
+        'post_id': post.post_id,
+        'username': post.username,
+        'image_url': url_for('static', filename=media_path('trip_posts', post.image)),
+        'post_url': url_for('post_view', post_id=post.post_id),
+        'caption': post.caption,
+        'timestamp': post.timestamp.isoformat(),
+        'like_count': post.like_count,
+        'liked_by_user': post.liked_by_user,
+        'comment_count': post.comment_count,
+    }
 
 @app.route('/', methods=['GET', 'POST'])
 def home():
@@ -286,39 +1745,28 @@ def home():
             file = request.files.get('image')
             caption = request.form.get('caption', '')
             if file and allowed_post_file(file.filename):
-                if not os.path.exists(POST_UPLOAD_FOLDER):
-                    os.makedirs(POST_UPLOAD_FOLDER)
-                filename = secure_filename(f"{session['username']}_{int(datetime.now().timestamp())}_{file.filename}")
-                file.save(os.path.join(POST_UPLOAD_FOLDER, filename))
-                post = TripPost(session['username'], filename, caption, datetime.now())
+                image_path = store_upload(file, POST_IMAGE_VARIANTS)
+                post = TripPost(session['username'], image_path, caption, datetime.now())
                 db.session.add(post)
+                db.session.flush()
+                index_post_caption(post)
                 db.session.commit()
+                fan_out_post(post)
                 flash('Post uploaded!', 'success')
                 return redirect(url_for('home'))
             else:
                 flash('Invalid file type.', 'danger')
 
         # Prepare posts for feed
-        all_posts = TripPost.query.order_by(TripPost.timestamp.desc()).all()
-        your_posts = [p for p in all_posts if p.username == session['username']]
-        other_posts = [p for p in all_posts if p.username != session['username']]
-        for post in all_posts:
-            post.like_count = TripPostLike.query.filter_by(post_id=post.post_id).count()
-            post.liked_by_user = TripPostLike.query.filter_by(post_id=post.post_id, username=session['username']).first() is not None
-            post.comments = TripPostComment.query.filter_by(post_id=post.post_id).order_by(TripPostComment.timestamp.asc()).all()
-        if 'username' in session:
-            posts_to_show = other_posts
-        else:
-            posts_to_show = all_posts
-        return render_template('home.html', your_posts=your_posts, posts_to_show=posts_to_show, all_posts=all_posts, active_page='home', get_avatar_url=get_avatar_url)
+        your_posts, _ = paginate_posts(TripPost.query.filter_by(username=session['username']))
+        posts_to_show, next_cursor = paginate_feed('home', session['username'], cursor=request.args.get('cursor'))
+        hydrate_posts(your_posts + posts_to_show, session['username'])
+        return render_template('home.html', your_posts=your_posts, posts_to_show=posts_to_show, next_cursor=next_cursor, feed='home', active_page='home', get_avatar_url=get_avatar_url)
     else:
         # For guests, just show the feed
-        all_posts = TripPost.query.order_by(TripPost.timestamp.desc()).all()
-        for post in all_posts:
-            post.like_count = TripPostLike.query.filter_by(post_id=post.post_id).count()
-            post.liked_by_user = False
-            post.comments = TripPostComment.query.filter_by(post_id=post.post_id).order_by(TripPostComment.timestamp.asc()).all()
-        return render_template('home.html', all_posts=all_posts, get_avatar_url=get_avatar_url)
+        posts_to_show, next_cursor = paginate_feed('home', cursor=request.args.get('cursor'))
+        hydrate_posts(posts_to_show)
+        return render_template('home.html', posts_to_show=posts_to_show, next_cursor=next_cursor, feed='home', get_avatar_url=get_avatar_url)
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -387,6 +1835,7 @@ def profile():
 
     # Get posts for this user
     posts = TripPost.query.filter_by(username=user.username).order_by(TripPost.timestamp.desc()).all()
+    prefetch_image_assets([media_path('trip_posts', post.image) for post in posts])
 
     # Get followers and following lists
     followers = [f.follower for f in Follow.query.filter_by(followed=user.username).all()]
@@ -410,18 +1859,16 @@ def edit_profile():
         file = request.files.get('profile_pic')
         print(f"[DEBUG] Received file: {file.filename if file else None}")
         if file and file.filename and allowed_file(file.filename):
-            ext = file.filename.rsplit('.', 1)[1].lower()
-            filename = secure_filename(f"{user.username}.{ext}")
-            print(f"[DEBUG] New profile pic filename: {filename}")
-            # Delete old profile pics with different extensions
-            for old_ext in ['jpg', 'jpeg', 'png', 'gif']:
-                old_filename = f"{user.username}.{old_ext}"
-                old_path = os.path.join(app.config['UPLOAD_FOLDER'], old_filename)
-                if old_ext != ext and os.path.exists(old_path):
+            filename = store_upload(file, AVATAR_VARIANTS)
+            print(f"[DEBUG] Saved new profile pic: {filename}")
+            # Release the previous picture; a pre-blob-store file belongs to this user alone
+            old_pic = user.profile_pic
+            if old_pic and not release_blob(old_pic):
+                old_path = os.path.join('static', media_path('profile_pics', old_pic))
+                if os.path.exists(old_path):
                     os.remove(old_path)
+                    remove_image_derivatives(media_path('profile_pics', old_pic))
                     print(f"[DEBUG] Deleted old profile pic: {old_path}")
-            file.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-            print(f"[DEBUG] Saved new profile pic: {filename}")
             user.profile_pic = filename
             user.profile_pic_updated_at = datetime.utcnow()
             print(f"[DEBUG] Updated user.profile_pic: {user.profile_pic}")
@@ -429,17 +1876,17 @@ def edit_profile():
         user.bio = bio
         user.interests = interests
         db.session.commit()
+        invalidate_user_summary(user.username)
         print(f"[DEBUG] Profile updated for user: {user.username}")
         flash('Profile updated!', 'success')
         return redirect(url_for('profile'))
-    return render_template('edit_profile.html', user=user, random=random.random)
+    return render_template('edit_profile.html', user=user)
 
 @app.route('/create_trip', methods=['GET', 'POST'])
 def create_trip():
     if 'username' not in session:
         return redirect(url_for('login'))
     if request.method == 'POST':
-        trip_id = get_next_trip_id()
         creator = session['username']
         destination = request.form['destination']
         start_date = request.form['start_date']
@@ -448,7 +1895,7 @@ def create_trip():
         preferences = request.form['preferences']
         participants = creator  # creator is the first participant
 
-        trip = Trip(trip_id, creator, destination, start_date, end_date, description, preferences, participants)
+        trip = Trip(creator, destination, start_date, end_date, description, preferences, participants)
         db.session.add(trip)
         db.session.commit()
         flash('Trip created successfully!', 'success')
@@ -491,12 +1938,10 @@ def join_trip(trip_id):
         # Add notification for trip creator
         creator = trip.creator
         if creator != username:
-            notification_id = get_next_notification_id()
             message = f"{username} joined your trip to {trip.destination}."
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            notification = Notification(notification_id, creator, 'trip_join', message, 0, timestamp)
-            db.session.add(notification)
+            notification = add_notification(creator, 'trip_join', message, actor=username, trip_id=trip.trip_id)
             db.session.commit()
+            push_notifications([notification])
         flash('You have joined the trip!', 'success')
     return redirect(url_for('list_trips'))
 
@@ -505,13 +1950,14 @@ def send_message(receiver):
     if 'username' not in session:
         return redirect(url_for('login'))
     if request.method == 'POST':
-        message_id = get_next_message_id()
         sender = session['username']
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        timestamp = datetime.utcnow()
         content = request.form['content']
-        message = Message(message_id, sender, receiver, timestamp, content)
+        message = Message(sender, receiver, timestamp, content)
         db.session.add(message)
+        record_message(message)
         db.session.commit()
+        deliver_message(message)
         flash('Message sent!', 'success')
         return redirect(url_for('inbox'))
     return render_template('send_message.html', receiver=receiver)
@@ -521,14 +1967,12 @@ def inbox():
     if 'username' not in session:
         return redirect(url_for('login'))
     messages = []
-    messages_df = Message.query.filter_by(receiver=session['username']).order_by(Message.timestamp.desc()).all()
+    messages_df = Message.query.filter_by(receiver=session['username']).order_by(Message.message_id.desc()).all()
     for msg in messages_df:
         messages.append(msg.__dict__)
     # Mark as read
-    for msg in messages_df:
-        if msg.is_read == 0:
-            msg.is_read = 1
-            db.session.commit()
+    mark_conversation_read(session['username'])
+    db.session.commit()
     return render_template('inbox.html', messages=messages)
 
 @app.route('/contact', methods=['GET', 'POST'])
@@ -548,12 +1992,11 @@ def review_user(reviewee, trip_id):
     if 'username' not in session:
         return redirect(url_for('login'))
     if request.method == 'POST':
-        review_id = get_next_review_id()
         reviewer = session['username']
         rating = int(request.form['rating'])
         comment = request.form['comment']
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        review = Review(review_id, reviewer, reviewee, trip_id, rating, comment, timestamp)
+        review = Review(reviewer, reviewee, trip_id, rating, comment, timestamp)
         db.session.add(review)
         db.session.commit()
         flash('Review submitted!', 'success')
@@ -563,46 +2006,116 @@ def review_user(reviewee, trip_id):
 def model_to_dict(obj):
     return {k: v for k, v in obj.__dict__.items() if not k.startswith('_')}
 
+NOTIFICATION_PAGE_SIZE = 30
+
+def decode_notification_cursor(cursor):
+    try:
+        timestamp, notification_id = cursor.rsplit('_', 1)
+        return timestamp, int(notification_id)
+    except (AttributeError, ValueError):
+        return None
+
 @app.route('/notifications')
 def notifications():
     if 'username' not in session:
         return redirect(url_for('login'))
+    # One query for the page: invitation status and trip details come from outer joins on the typed keys.
+    # Folded rows keep their id but take the latest timestamp, so the page is ordered by (timestamp, id).
+    before = decode_notification_cursor(request.args.get('before'))
+    query = (
+        db.session.query(Notification, Invitation, Trip)
+        .outerjoin(Invitation, Invitation.invitation_id == Notification.invitation_id)
+        .outerjoin(Trip, Trip.trip_id == Notification.trip_id)
+        .filter(Notification.username == session['username'])
+    )
+    if before:
+        timestamp, notification_id = before
+        query = query.filter(db.or_(
+            Notification.timestamp < timestamp,
+            db.and_(Notification.timestamp == timestamp, Notification.notification_id < notification_id)
+        ))
+    rows = (
+        query.order_by(Notification.timestamp.desc(), Notification.notification_id.desc())
+        .limit(NOTIFICATION_PAGE_SIZE + 1).all()
+    )
+    next_before = None
+    if len(rows) > NOTIFICATION_PAGE_SIZE:
+        last = rows[NOTIFICATION_PAGE_SIZE - 1][0]
+        next_before = f"{last.timestamp}_{last.notification_id}"
     notifications = []
-    notifications_df = Notification.query.filter_by(username=session['username']).order_by(Notification.timestamp.desc()).all()
-    for notif in notifications_df:
+    for notif, invitation, trip in rows[:NOTIFICATION_PAGE_SIZE]:
         notif_dict = model_to_dict(notif)
-        # Attach inviter, invitation_id, status, and trip details for trip_invite (any status)
-        if notif.type == 'trip_invite':
-            # Try to extract inviter from the message if not present
-            inviter = notif_dict.get('inviter')
-            if not inviter:
-                inviter = notif.message.split(' ')[0]
-            # Find the most recent invitation for this notification, regardless of status
-            invitation = Invitation.query.filter_by(
-                invitee=session['username'],
-                inviter=inviter
-            ).order_by(Invitation.timestamp.desc()).first()
-            if invitation:
-                notif_dict['inviter'] = invitation.inviter
-                notif_dict['invitation_id'] = invitation.invitation_id
-                notif_dict['invite_status'] = invitation.status
-                trip = Trip.query.filter_by(trip_id=invitation.trip_id).first()
-                if trip:
-                    notif_dict['trip_destination'] = trip.destination
-                    notif_dict['trip_start'] = trip.start_date
-                    notif_dict['trip_end'] = trip.end_date
+        if invitation:
+            notif_dict['inviter'] = invitation.inviter
+            notif_dict['invite_status'] = invitation.status
+        if trip:
+            notif_dict['trip_destination'] = trip.destination
+            notif_dict['trip_start'] = trip.start_date
+            notif_dict['trip_end'] = trip.end_date
         notifications.append(notif_dict)
-    # Mark as read
-    for notif in notifications_df:
-        if notif.is_read == 0:
-            notif.is_read = 1
-            db.session.commit()
+    # Mark everything read in one UPDATE and reset the counter with it
+    Notification.query.filter_by(username=session['username'], is_read=0).update({Notification.is_read: 1}, synchronize_session=False)
+    User.query.filter_by(username=session['username']).update({User.unread_notifications: 0}, synchronize_session=False)
+    db.session.commit()
+    set_unread_count(session['username'], 0)
     # Get pending invitations for this user
     invitations = []
     invitations_df = Invitation.query.filter_by(invitee=session['username']).filter_by(status='pending').all()
     for inv in invitations_df:
         invitations.append(model_to_dict(inv))
-    return render_template('notifications.html', notifications=notifications, invitations=invitations, get_avatar_url=get_avatar_url)
+    # Rows from before the backfill have no actor; the template falls back to the message's first word
+    prefetch_user_summaries({n['actor'] or n['message'].split(' ')[0] for n in notifications})
+    return render_template('notifications.html', notifications=notifications, invitations=invitations, next_before=next_before, get_avatar_url=get_avatar_url)
+
+@app.cli.command('backfill-notifications')
+def backfill_notifications_command():
+    # Older rows only carry free text, e.g. "alice invited you to join a trip to Goa."
+    usernames = {username for (username,) in db.session.query(User.username)}
+    filled = 0
+    for notif in Notification.query.filter(Notification.actor.is_(None)).order_by(Notification.notification_id):
+        actor = notif.message.split(' ')[0]
+        if actor not in usernames:
+            continue
+        notif.actor = actor
+        if notif.type == 'trip_invite':
+            invitation = (
+                Invitation.query.filter_by(invitee=notif.username, inviter=actor)
+                .filter(Invitation.timestamp <= notif.timestamp)
+                .order_by(Invitation.timestamp.desc()).first()
+            )
+        elif notif.type == 'trip_invite_response':
+            status = 'accepted' if ' accepted ' in notif.message else 'rejected'
+            invitation = (
+                Invitation.query.filter_by(inviter=notif.username, invitee=actor, status=status)
+                .filter(Invitation.timestamp <= notif.timestamp)
+                .order_by(Invitation.timestamp.desc()).first()
+            )
+        else:
+            invitation = None
+        if invitation:
+            notif.invitation_id = invitation.invitation_id
+            notif.trip_id = invitation.trip_id
+        if notif.type == 'trip_join':
+            destination = notif.message.rsplit(' trip to ', 1)[-1].rstrip('.')
+            trip = Trip.query.filter_by(creator=notif.username, destination=destination).order_by(Trip.trip_id.desc()).first()
+            notif.trip_id = trip.trip_id if trip else None
+        elif notif.type == 'comment':
+            comment = (
+                TripPostComment.query.join(TripPost, TripPost.post_id == TripPostComment.post_id)
+                .filter(TripPost.username == notif.username, TripPostComment.username == actor)
+                .order_by(TripPostComment.id.desc()).first()
+            )
+            notif.post_id = comment.post_id if comment else None
+        elif notif.type == 'like':
+            # Likes carry no timestamp; only link when the actor liked exactly one of the recipient's posts
+            liked = (
+                db.session.query(TripPostLike.post_id).join(TripPost, TripPost.post_id == TripPostLike.post_id)
+                .filter(TripPost.username == notif.username, TripPostLike.username == actor).limit(2).all()
+            )
+            notif.post_id = liked[0].post_id if len(liked) == 1 else None
+        filled += 1
+    db.session.commit()
+    print(f"Backfilled {filled} notification(s).")
 
 @app.route('/invite/<int:trip_id>/<invitee>', methods=['POST'])
 def invite_user(trip_id, invitee):
@@ -624,18 +2137,18 @@ def invite_user(trip_id, invitee):
         if (datetime.now() - last_time).total_seconds() < 86400:
             flash('You have already invited this user to this trip in the last 24 hours.', 'warning')
             return redirect(url_for('invite_page', trip_id=trip_id))
-    invitation_id = get_next_invitation_id()
     timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
     status = 'pending'
-    invitation = Invitation(invitation_id, trip_id, inviter, invitee, status, timestamp)
+    invitation = Invitation(trip_id, inviter, invitee, status, timestamp)
     db.session.add(invitation)
     db.session.commit()
     # --- Add notification for invitee ---
-    notification_id = get_next_notification_id()
     message = f"{inviter} invited you to join a trip to {trip.destination}."
-    notification = Notification(notification_id, invitee, 'trip_invite', message, 0, timestamp)
-    db.session.add(notification)
+    notification = add_notification(
+        invitee, 'trip_invite', message, timestamp, actor=inviter, trip_id=trip_id, invitation_id=invitation.invitation_id
+    )
     db.session.commit()
+    push_notifications([notification])
     flash(f'Invitation sent to {invitee}!', 'success')
     return redirect(url_for('list_trips'))
 
@@ -659,17 +2172,17 @@ def respond_invitation(invitation_id, response):
     invitation.status = response
     db.session.commit()
     # Notify inviter
-    from datetime import datetime
-    notification_id = get_next_notification_id()
     trip = Trip.query.filter_by(trip_id=invitation.trip_id).first()
     if response == 'accepted':
         message = f"{invitation.invitee} accepted your trip invitation to {trip.destination}."
     else:
         message = f"{invitation.invitee} rejected your trip invitation to {trip.destination}."
-    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-    notification = Notification(notification_id, invitation.inviter, 'trip_invite_response', message, 0, timestamp)
-    db.session.add(notification)
+    notification = add_notification(
+        invitation.inviter, 'trip_invite_response', message,
+        actor=invitation.invitee, trip_id=invitation.trip_id, invitation_id=invitation.invitation_id
+    )
     db.session.commit()
+    push_notifications([notification])
     if response == 'accepted':
         # Optionally, add user to trip participants
         trip_id = invitation.trip_id
@@ -702,10 +2215,9 @@ def trip_gallery(trip_id):
     if request.method == 'POST':
         file = request.files.get('photo')
         if file and allowed_photo(file.filename):
-            filename = secure_filename(f"{trip_id}_{session['username']}_{file.filename}")
-            photo_id = get_next_photo_id()
+            filename = store_upload(file)
             timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            photo = TripPhoto(photo_id, trip_id, session['username'], filename, timestamp)
+            photo = TripPhoto(trip_id, session['username'], filename, timestamp)
             db.session.add(photo)
             db.session.commit()
             flash('Photo uploaded!', 'success')
@@ -777,6 +2289,7 @@ def view_profile(username):
         flash('User not found.', 'danger')
         return redirect(url_for('home'))
     posts = TripPost.query.filter_by(username=username).order_by(TripPost.timestamp.desc()).all()
+    prefetch_image_assets([media_path('trip_posts', post.image) for post in posts])
     followers = [f.follower for f in Follow.query.filter_by(followed=username).all()]
     following = [f.followed for f in Follow.query.filter_by(follower=username).all()]
     is_following = False
@@ -789,12 +2302,11 @@ def report_user(reported):
     if 'username' not in session:
         return redirect(url_for('login'))
     if request.method == 'POST':
-        report_id = get_next_report_id()
         reporter = session['username']
         reason = request.form['reason']
         details = request.form.get('details', '')
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        report = Report(report_id, reporter, reported, reason, details, timestamp)
+        report = Report(reporter, reported, reason, details, timestamp)
         db.session.add(report)
         db.session.commit()
         flash('Report submitted. Thank you for helping keep the community safe.', 'success')
@@ -842,59 +2354,37 @@ def trip_posts():
         file = request.files.get('image')
         caption = request.form.get('caption', '')
         if file and allowed_post_file(file.filename):
-            if not os.path.exists(POST_UPLOAD_FOLDER):
-                os.makedirs(POST_UPLOAD_FOLDER)
-            filename = secure_filename(f"{session['username']}_{int(datetime.now().timestamp())}_{file.filename}")
-            file.save(os.path.join(POST_UPLOAD_FOLDER, filename))
-            post = TripPost(session['username'], filename, caption, datetime.now())
+            image_path = store_upload(file, POST_IMAGE_VARIANTS)
+            post = TripPost(session['username'], image_path, caption, datetime.now())
             db.session.add(post)
+            db.session.flush()
+            index_post_caption(post)
             db.session.commit()
+            fan_out_post(post)
             flash('Post uploaded!', 'success')
             return redirect(url_for('trip_posts'))
         else:
             flash('Invalid file type.', 'danger')
-    posts = TripPost.query.order_by(TripPost.timestamp.desc()).all()
-    for post in posts:
-        post.like_count = TripPostLike.query.filter_by(post_id=post.post_id).count()
-        post.liked_by_user = False
-        if 'username' in session:
-            post.liked_by_user = TripPostLike.query.filter_by(post_id=post.post_id, username=session['username']).first() is not None
-        post.comments = TripPostComment.query.filter_by(post_id=post.post_id).order_by(TripPostComment.timestamp.asc()).all()
-    return render_template('trip_posts.html', posts=posts, get_avatar_url=get_avatar_url)
+    posts, next_cursor = paginate_feed('trip_posts', cursor=request.args.get('cursor'))
+    hydrate_posts(posts, session.get('username'))
+    return render_template('trip_posts.html', posts=posts, next_cursor=next_cursor, feed='trip_posts', get_avatar_url=get_avatar_url)
 
 @app.route('/post/<int:post_id>')
 def post_view(post_id):
     post = TripPost.query.get_or_404(post_id)
-    like_count = TripPostLike.query.filter_by(post_id=post_id).count()
-    liked_by_user = False
-    if 'username' in session:
-        liked_by_user = TripPostLike.query.filter_by(post_id=post_id, username=session['username']).first() is not None
-    comments = TripPostComment.query.filter_by(post_id=post_id).order_by(TripPostComment.timestamp.asc()).all()
-    return render_template('post_view.html', post=post, like_count=like_count, liked_by_user=liked_by_user, comments=comments)
+    hydrate_posts([post], session.get('username'), comment_limit=COMMENT_PAGE_SIZE)
+    return render_template('post_view.html', post=post, like_count=post.like_count, liked_by_user=post.liked_by_user, comments=post.comments)
 
 @app.route('/trip_post/<int:post_id>/like', methods=['POST'])
 def like_trip_post(post_id):
     if 'username' not in session:
         return jsonify({'success': False}), 401
-    like = TripPostLike.query.filter_by(post_id=post_id, username=session['username']).first()
     post = TripPost.query.get(post_id)
-    if like:
-        db.session.delete(like)
-        db.session.commit()
-        return jsonify({'liked': False, 'count': TripPostLike.query.filter_by(post_id=post_id).count()})
-    else:
-        new_like = TripPostLike(post_id, session['username'])
-        db.session.add(new_like)
-        db.session.commit()
-        # --- Notification for like ---
-        if post and post.username != session['username']:
-            notification_id = get_next_notification_id()
-            message = f"{session['username']} liked your post."
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            notification = Notification(notification_id, post.username, 'like', message, 0, timestamp)
-            db.session.add(notification)
-            db.session.commit()
-        return jsonify({'liked': True, 'count': TripPostLike.query.filter_by(post_id=post_id).count()})
+    if not post:
+        return jsonify({'success': False}), 404
+    # Buffered: the write and the like notification happen in the next flush
+    liked = toggle_like(post_id, session['username'])
+    return jsonify({'liked': liked, 'count': post.like_count + buffered_like_delta(post_id)})
 
 @app.route('/trip_post/<int:post_id>/comment', methods=['POST'])
 def comment_trip_post(post_id):
@@ -902,19 +2392,47 @@ def comment_trip_post(post_id):
         return redirect(url_for('login'))
     comment_text = request.form.get('comment')
     post = TripPost.query.get(post_id)
-    if comment_text:
+    if post and comment_text:
         comment = TripPostComment(post_id, session['username'], comment_text, datetime.now())
         db.session.add(comment)
+        adjust_post_counter(post_id, TripPost.comment_count, 1)
         db.session.commit()
-        # --- Notification for comment ---
+        comment_html = render_template('comment_item.html', comment=comment)
         if post and post.username != session['username']:
-            notification_id = get_next_notification_id()
             message = f"{session['username']} commented on your post."
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            notification = Notification(notification_id, post.username, 'comment', message, 0, timestamp)
-            db.session.add(notification)
+            notification = add_notification(post.username, 'comment', message, actor=session['username'], post_id=post_id)
             db.session.commit()
-    return redirect(url_for('trip_posts'))
+            push_notifications([notification])
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+            return jsonify({'success': True, 'html': comment_html, 'comment_count': post.comment_count})
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        return jsonify({'success': False}), 400
+    return redirect(url_for('post_view', post_id=post_id) + '#comments')
+
+# Older comments, newest first, keyset-paginated on comment id
+@app.route('/trip_post/<int:post_id>/comments')
+def trip_post_comments(post_id):
+    query = TripPostComment.query.filter_by(post_id=post_id)
+    cursor = request.args.get('cursor', '')
+    if cursor.isdigit():
+        query = query.filter(TripPostComment.id < int(cursor))
+    comments = query.order_by(TripPostComment.id.desc()).limit(COMMENT_PAGE_SIZE + 1).all()
+    next_cursor = comments[COMMENT_PAGE_SIZE - 1].id if len(comments) > COMMENT_PAGE_SIZE else None
+    comments = comments[:COMMENT_PAGE_SIZE]
+    return jsonify({
+        'comments': [
+            {
+                'id': comment.id,
+                'username': comment.username,
+                'comment_html': comment.comment_html,
+                'timestamp': comment.timestamp.isoformat(),
+            } for comment in comments
+        ],
+        # Oldest first, ready to prepend above the comments already shown
+        'html': ''.join(render_template('comment_item.html', comment=comment) for comment in reversed(comments)),
+        'next_cursor': next_cursor,
+        'next_url': url_for('trip_post_comments', post_id=post_id, cursor=next_cursor) if next_cursor else None,
+    })
 
 @app.route('/delete_post/<int:post_id>', methods=['POST'])
 def delete_post(post_id):
@@ -922,10 +2440,19 @@ def delete_post(post_id):
         return redirect(url_for('login'))
     post = TripPost.query.get(post_id)
     if post and post.username == session['username']:
-        # Delete the image file from disk
-        image_path = os.path.join('static/trip_posts', post.image)
-        if os.path.exists(image_path):
-            os.remove(image_path)
+        # Shared blobs are only released here; gc-blobs removes the file once nothing references it
+        if not release_blob(post.image):
+            image_path = os.path.join('static/trip_posts', post.image)
+            if os.path.exists(image_path):
+                os.remove(image_path)
+            remove_image_derivatives('trip_posts/' + post.image)
+        # Likes and comments go in the same transaction so no counter outlives its rows
+        TripPostLike.query.filter_by(post_id=post_id).delete()
+        TripPostComment.query.filter_by(post_id=post_id).delete()
+        TimelineEntry.query.filter_by(post_id=post_id).delete()
+        unindex_post(post_id)
+        PostScore.query.filter_by(post_id=post_id).delete()
+        Notification.query.filter_by(post_id=post_id).update({Notification.post_id: None}, synchronize_session=False)
         db.session.delete(post)
         db.session.commit()
         flash('Post deleted!', 'success')
@@ -943,85 +2470,52 @@ def edit_post(post_id):
         return redirect(url_for('profile'))
     if request.method == 'POST':
         post.caption = request.form.get('caption', '')
+        post.caption_html = render_tags_and_mentions(post.caption)
+        index_post_caption(post)
         db.session.commit()
         flash('Post updated!', 'success')
         return redirect(url_for('profile'))
     return render_template('edit_post.html', post=post)
 
-def get_all_users_except(current_user):
-    users = []
-    with open('users.csv', newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['username'] != current_user:
-                users.append(row['username'])
-    return users
-
-def get_display_name(username):
-    with open('users.csv', newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            if row['username'] == username:
-                return row.get('display_name', username) or username
-    return username
-
 def get_avatar_url(username):
-    user = User.query.filter_by(username=username).first()
-    if user and user.profile_pic:
-        return url_for('static', filename=f'profile_pics/{user.profile_pic}')
+    summary = get_user_summary(username)
+    if summary and summary['avatar_path']:
+        return url_for('static', filename=summary['avatar_path'])
     # Fallback to default avatar
     return url_for('static', filename='default_avatar.png')
 
-def get_last_message_and_unread(current_user, other_user):
-    last_msg = ""
-    unread = False
-    last_time = ""
-    with open('messages.csv', newline='', encoding='utf-8') as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            # Check both directions
-            if (row['sender'] == current_user and row['receiver'] == other_user) or \
-               (row['sender'] == other_user and row['receiver'] == current_user):
-                last_msg = row['content']
-                last_time = row.get('timestamp', '')
-                # Mark as unread if the last message is from other_user and not marked as read
-                if row['receiver'] == current_user and row['sender'] == other_user and row.get('read', '0') == '0':
-                    unread = True
-    if last_time:
-        last_msg = f"{last_msg} · {last_time}"
-    return last_msg, unread
-
 @app.route('/messages')
 def messages():
     if 'username' not in session:
         return redirect(url_for('login'))
     current_user = session['username']
-    # Find all users who have a conversation (sent or received messages) with current_user
-    user_set = set()
-    all_msgs = Message.query.filter((Message.sender == current_user) | (Message.receiver == current_user)).all()
-    for msg in all_msgs:
-        if msg.sender != current_user:
-            user_set.add(msg.sender)
-        if msg.receiver != current_user:
-            user_set.add(msg.receiver)
-    conversations = []
-    now = datetime.utcnow()
-    for user in user_set:
-        last_msg, unread = get_last_message_and_unread(current_user, user)
-        user_obj = User.query.filter_by(username=user).first()
-        is_online = False
-        if user_obj and user_obj.last_seen:
-            is_online = (now - user_obj.last_seen).total_seconds() < 120  # 2 minutes
-        conversations.append({
-            'username': user,
-            'avatar_url': get_avatar_url(user),
-            'last_message': last_msg,
-            'unread': unread,
-            'is_online': is_online
-        })
-    # Sort by unread and last message time
-    conversations.sort(key=lambda x: (not x['unread'], x['last_message']), reverse=True)
-    return render_template('dm_layout.html', conversations=conversations, active_user=None, get_avatar_url=get_avatar_url)
+    # Everyone current_user has a conversation with, most recent activity first
+    rows, next_cursor = paginate_conversations(current_user, request.args.get('cursor'))
+    conversations = sidebar_entries(current_user, rows)
+    return render_template(
+        'dm_layout.html',
+        conversations=conversations,
+        active_user=None,
+        sidebar_cursor=next_cursor,
+        get_avatar_url=get_avatar_url
+    )
+
+@app.route('/messages/conversations')
+def conversation_page():
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    current_user = session['username']
+    active_user = request.args.get('active')
+    rows, next_cursor = paginate_conversations(current_user, request.args.get('cursor'), exclude=active_user)
+    html = ''.join(
+        render_template('dm_sidebar_item.html', convo=convo, active_user=active_user)
+        for convo in sidebar_entries(current_user, rows)
+    )
+    return jsonify({
+        'html': html,
+        'next_cursor': next_cursor,
+        'next_url': url_for('conversation_page', cursor=next_cursor, active=active_user) if next_cursor else None,
+    })
 
 @app.route('/new_message')
 def new_message():
@@ -1029,13 +2523,7 @@ def new_message():
         return redirect(url_for('login'))
     current_user = session['username']
     # Find users with whom there is NO conversation
-    user_set = set()
-    all_msgs = Message.query.filter((Message.sender == current_user) | (Message.receiver == current_user)).all()
-    for msg in all_msgs:
-        if msg.sender != current_user:
-            user_set.add(msg.sender)
-        if msg.receiver != current_user:
-            user_set.add(msg.receiver)
+    user_set = {c.partner for c in conversation_summaries(current_user)}
     # All users except current and those in user_set
     all_users = [u.username for u in User.query.all() if u.username != current_user and u.username not in user_set]
     return render_template('new_message.html', users=all_users)
@@ -1049,13 +2537,8 @@ def chat(username):
         file = request.files.get('attachment')
         filename = None
         if file and file.filename:
-            if not os.path.exists(UPLOAD_FOLDER):
-                os.makedirs(UPLOAD_FOLDER)
-            filename = secure_filename(f"{session['username']}_{int(datetime.utcnow().timestamp())}_{file.filename}")
-            file.save(os.path.join(UPLOAD_FOLDER, filename))
-        message_id = get_next_message_id()
+            filename = store_upload(file, ATTACHMENT_VARIANTS if allowed_file(file.filename) else None)
         message = Message(
-            message_id,
             session['username'],
             username,
             datetime.utcnow(),
@@ -1064,82 +2547,101 @@ def chat(username):
             filename
         )
         db.session.add(message)
+        record_message(message)
         db.session.commit()
+        deliver_message(message)
         return redirect(url_for('chat', username=username))
-    # Get all messages between the two users
-    messages = Message.query.filter(
-        ((Message.sender == session['username']) & (Message.receiver == username)) |
-        ((Message.sender == username) & (Message.receiver == session['username']))
-    ).order_by(Message.timestamp).all()
+    # Only the newest page; older ones load from get_older_chat_messages
+    messages, older_cursor = paginate_chat_messages(session['username'], username, request.args.get('before', type=int))
 
     # Mark all messages from 'username' to current user as read
-    for msg in messages:
-        if msg.sender == username and msg.receiver == session['username'] and msg.is_read == 0:
-            msg.is_read = 1
+    mark_conversation_read(session['username'], username)
     db.session.commit()
 
-    other_user_obj = User.query.filter_by(username=username).first()
-    is_online = False
-    last_seen = None
-    if other_user_obj and other_user_obj.last_seen:
-        now = datetime.utcnow()
-        last_seen = other_user_obj.last_seen
-        is_online = (now - last_seen).total_seconds() < 120  # 2 minutes
-
-    # Prepare conversations for sidebar
+    # Prepare conversations for sidebar; the open chat is pinned on top when it is not on the first page
     current_user = session['username']
-    conversations = []
-    now = datetime.utcnow()
-    for user in get_all_users_except(current_user):
-        last_msg, unread = get_last_message_and_unread(current_user, user)
-        user_obj = User.query.filter_by(username=user).first()
-        is_online_sidebar = False
-        if user_obj and user_obj.last_seen:
-            is_online_sidebar = (now - user_obj.last_seen).total_seconds() < 120
-        conversations.append({
-            'username': user,
-            'display_name': get_display_name(user),
-            'avatar_url': get_avatar_url(user),
-            'last_message': last_msg,
-            'unread': unread,
-            'is_online': is_online_sidebar
-        })
-    conversations.sort(key=lambda x: (not x['unread'], x['last_message']), reverse=True)
+    rows, next_cursor = paginate_conversations(current_user, request.args.get('cursor'))
+    if username != current_user and all(row.partner != username for row in rows):
+        active = Conversation.query.filter_by(username=current_user, partner=username).first()
+        rows = [active or Conversation(current_user, username, 0, current_user, '', '')] + rows
+    conversations = sidebar_entries(current_user, rows)
+    last_seen = presence_snapshot({username})[username]
+    is_online = is_online_at(last_seen, datetime.utcnow())
 
     return render_template(
         'dm_layout.html',
         conversations=conversations,
         active_user=username,
+        sidebar_cursor=next_cursor,
         messages=messages,
+        older_cursor=older_cursor,
         other_user=username,
         is_online=is_online,
         last_seen=last_seen,
         get_avatar_url=get_avatar_url
     )
 
+def message_to_dict(msg):
+    return {
+        'id': msg.message_id,
+        'sender': msg.sender,
+        'receiver': msg.receiver,
+        'content': msg.content,
+        'timestamp': str(msg.timestamp),
+        'sent_at': msg.sent_at.isoformat() if msg.sent_at else None,
+        'attachment': msg.attachment,
+        'attachment_url': url_for('static', filename=media_path('profile_pics', msg.attachment)) if msg.attachment else None,
+    }
+
+# Delta sync: ?after=<message_id> returns only newer messages. The ETag is the pair's
+# last message id, so a poll with nothing new is a 304 off one Conversation lookup.
+CHAT_SYNC_LIMIT = 100
+
 @app.route('/chat/<username>/messages')
 def get_chat_messages(username):
     if 'username' not in session:
         return jsonify({'error': 'Not logged in'}), 401
-    # Get all messages between the two users
-    messages = Message.query.filter(
-        ((Message.sender == session['username']) & (Message.receiver == username)) |
-        ((Message.sender == username) & (Message.receiver == session['username']))
-    ).order_by(Message.timestamp).all()
-    # Mark as read (optional, or keep in main chat route)
-    for msg in messages:
-        if msg.sender == username and msg.receiver == session['username'] and msg.is_read == 0:
-            msg.is_read = 1
-    db.session.commit()
-    # Return messages as JSON
-    return jsonify([
-        {
-            'sender': msg.sender,
-            'content': msg.content,
-            'timestamp': str(msg.timestamp),
-            'attachment': msg.attachment
-        } for msg in messages
-    ])
+    current_user = session['username']
+    after = request.args.get('after', 0, type=int)
+    convo = Conversation.query.filter_by(username=current_user, partner=username).first()
+    last_id = convo.last_message_id if convo else 0
+    etag = f"chat-{last_id}"
+    if request.if_none_match.contains(etag) or after >= last_id:
+        response = jsonify({'messages': [], 'last_id': max(after, last_id), 'has_more': False})
+        response.set_etag(etag)
+        response = response.make_conditional(request)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    messages = (
+        conversation_messages(current_user, username).filter(Message.message_id > after)
+        .order_by(Message.message_id).limit(CHAT_SYNC_LIMIT + 1).all()
+    )
+    has_more = len(messages) > CHAT_SYNC_LIMIT
+    messages = messages[:CHAT_SYNC_LIMIT]
+    if convo and convo.unread_count:
+        mark_conversation_read(current_user, username)
+        db.session.commit()
+    response = jsonify({
+        'messages': [message_to_dict(msg) for msg in messages],
+        'last_id': messages[-1].message_id if messages else after,
+        'has_more': has_more,
+    })
+    # A truncated page is not the full delta, so it must not validate later polls
+    if not has_more:
+        response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/chat/<username>/messages/older')
+def get_older_chat_messages(username):
+    if 'username' not in session:
+        return jsonify({'error': 'Not logged in'}), 401
+    messages, older_cursor = paginate_chat_messages(session['username'], username, request.args.get('before', type=int))
+    return jsonify({
+        'messages': [message_to_dict(msg) for msg in messages],
+        'older_cursor': older_cursor,
+        'older_url': url_for('get_older_chat_messages', username=username, before=older_cursor) if older_cursor else None,
+    })
 
 @app.route('/chat/<username>/typing', methods=['POST'])
 def set_typing(username):
@@ -1163,11 +2665,9 @@ def is_typing(username):
 
 @app.before_request
 def update_last_seen():
-    if 'username' in session:
-        user = User.query.filter_by(username=session['username']).first()
-        if user:
-            user.last_seen = datetime.utcnow()
-            db.session.commit()
+    # In-memory only; flush_presence writes the batch
+    if 'username' in session and request.endpoint != 'static':
+        record_heartbeat(session['username'])
 
 @app.route('/follow/<username>', methods=['POST'])
 def follow_user(username):
@@ -1183,15 +2683,14 @@ def follow_user(username):
     if not existing_follow:
         follow = Follow(session['username'], username)
         db.session.add(follow)
+        backfill_timeline(session['username'], username)
         db.session.commit()
         # --- Notification for follow ---
         if session['username'] != username:
-            notification_id = get_next_notification_id()
             message = f"{session['username']} started following you."
-            timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-            notification = Notification(notification_id, username, 'follow', message, 0, timestamp)
-            db.session.add(notification)
+            notification = add_notification(username, 'follow', message, actor=session['username'])
             db.session.commit()
+            push_notifications([notification])
         flash(f'You are now following {username}!', 'success')
     else:
         flash(f'You are already following {username}.', 'info')
@@ -1211,6 +2710,7 @@ def unfollow_user(username):
     
     if follow:
         db.session.delete(follow)
+        prune_timeline(session['username'], username)
         db.session.commit()
         flash(f'You have unfollowed {username}.', 'success')
     else:
@@ -1221,20 +2721,54 @@ def unfollow_user(username):
 @app.route('/explore')
 def explore():
     print("Registering /explore route")
-    posts = TripPost.query.order_by(TripPost.timestamp.desc()).limit(30).all()
-    for post in posts:
-        post.like_count = TripPostLike.query.filter_by(post_id=post.post_id).count()
-        post.liked_by_user = False
-        if 'username' in session:
-            post.liked_by_user = TripPostLike.query.filter_by(post_id=post.post_id, username=session['username']).first() is not None
-        post.comments = TripPostComment.query.filter_by(post_id=post.post_id).order_by(TripPostComment.timestamp.asc()).all()
-    return render_template('explore.html', posts=posts)
+    posts, next_cursor = paginate_feed('explore', cursor=request.args.get('cursor'))
+    hydrate_posts(posts, session.get('username'))
+    return render_template('explore.html', posts=posts, next_cursor=next_cursor, feed='explore')
 
 @app.route('/hashtag/<tag>')
 def hashtag(tag):
-    posts = TripPost.query.filter(TripPost.caption.ilike(f'%#{tag}%')).order_by(TripPost.timestamp.desc()).all()
-    # ...add like/comment info as before...
-    return render_template('hashtag.html', tag=tag, posts=posts)
+    posts, next_cursor = paginate_feed('hashtag', tag=tag, cursor=request.args.get('cursor'))
+    hydrate_posts(posts, session.get('username'))
+    return render_template('hashtag.html', tag=tag, posts=posts, next_cursor=next_cursor, feed='hashtag')
+
+@app.route('/trending_tags')
+def trending_tags():
+    since = datetime.utcnow() - timedelta(hours=TRENDING_WINDOW_HOURS)
+    total = db.func.sum(HashtagCount.count)
+    rows = (
+        db.session.query(HashtagCount.tag, total.label('count'))
+        .filter(HashtagCount.bucket >= since.replace(minute=0, second=0, microsecond=0))
+        .group_by(HashtagCount.tag)
+        .order_by(total.desc())
+        .limit(TRENDING_LIMIT)
+        .all()
+    )
+    return jsonify([
+        {'tag': tag, 'count': count, 'url': url_for('hashtag', tag=tag)}
+        for tag, count in rows
+    ])
+
+# JSON "next page" for infinite scroll on the feed templates
+@app.route('/feed/<feed>')
+def feed_page(feed):
+    if feed not in FEED_CARD_TEMPLATES:
+        return jsonify({'error': 'Unknown feed'}), 404
+    viewer = session.get('username')
+    if feed == 'trip_posts' and not viewer:
+        return jsonify({'error': 'Not logged in'}), 401
+    tag = request.args.get('tag')
+    posts, next_cursor = paginate_feed(feed, viewer, tag, request.args.get('cursor'))
+    hydrate_posts(posts, viewer)
+    html = ''.join(
+        render_template(FEED_CARD_TEMPLATES[feed], post=post, get_avatar_url=get_avatar_url)
+        for post in posts
+    )
+    return jsonify({
+        'posts': [post_to_dict(post) for post in posts],
+        'html': html,
+        'next_cursor': next_cursor,
+        'next_url': url_for('feed_page', feed=feed, cursor=next_cursor, tag=tag) if next_cursor else None,
+    })
 
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='eventlet')
 
@@ -1245,6 +2779,7 @@ user_sid_map = {}
 def handle_connect():
     if 'username' in session:
         user_sid_map[session['username']] = request.sid
+        join_room(notification_room(session['username']))
         print(f"[SocketIO] {session['username']} connected with sid {request.sid}")
 
 @socketio.on('register-username')
@@ -1261,16 +2796,129 @@ def handle_disconnect():
             print(f"[SocketIO] {user} disconnected")
             del user_sid_map[user]
 
-@socketio.on('send_message')
-def handle_send_message(data):
-    # data: {sender, receiver, content, audio, sticker, ...}
-    room = get_room_name(data['sender'], data['receiver'])
-    emit('receive_message', data, room=room)
+# --- Socket.IO chat: messages persisted in batches and delivered to each user's personal room ---
+# Handlers queue the message and wait for the flush that assigns its ID, so the ack can carry it.
+# The flusher is a Socket.IO background task, so under eventlet that wait yields instead of blocking.
+MESSAGE_FLUSH_SECONDS = 0.2
+MESSAGE_ACK_TIMEOUT = 3 # Clients wait 10s (MESSAGE_ACK_WAIT_MS) before retrying over HTTP; stay well inside that
+pending_messages = []
+pending_messages_lock = threading.Lock()
+message_flusher = {'started': False}
+
+def deliver_message(message, skip_sid=None, **extra):
+    payload = message_to_dict(message)
+    payload.update(extra)
+    socketio.emit(
+        'receive_message', payload,
+        to=[notification_room(message.receiver), notification_room(message.sender)], skip_sid=skip_sid
+    )
+    return payload
+
+def decode_voice_note(data_url):
+    # data:audio/webm;base64,...
+    header, _, encoded = (data_url or '').partition(',')
+    if not header.startswith('data:audio/') or ';base64' not in header:
+        return None
+    if len(encoded) * 3 // 4 > UPLOAD_LIMITS['attachment']:
+        return None
+    try:
+        return base64.b64decode(encoded, validate=True)
+    except ValueError:
+        return None
+
+def queue_message(sender, receiver, content, voice_note=None):
+    entry = {
+        'sender': sender, 'receiver': receiver, 'content': content, 'voice_note': voice_note,
+        'sent_at': datetime.utcnow(), 'done': socketio.server.eio.create_event(), 'message': None,
+    }
+    with pending_messages_lock:
+        pending_messages.append(entry)
+    start_message_flusher()
+    return entry
+
+def flush_pending_messages():
+    with pending_messages_lock:
+        if not pending_messages:
+            return
+        batch = list(pending_messages)
+        pending_messages.clear()
+    try:
+        with app.app_context():
+            messages = []
+            for entry in batch:
+                attachment = None
+                if entry['voice_note']:
+                    attachment, _ = store_blob(io.BytesIO(entry['voice_note']), 'voice.webm')
+                messages.append(Message(entry['sender'], entry['receiver'], entry['sent_at'], entry['content'], 0, attachment))
+            db.session.add_all(messages)
+            for message in messages:
+                record_message(message)
+            # Detached, the rows keep their loaded values after commit for the waiting handlers
+            for message in messages:
+                db.session.expunge(message)
+            db.session.commit()
+            for entry, message in zip(batch, messages):
+                entry['message'] = message
+    finally:
+        for entry in batch:
+            entry['done'].set()
+
+def run_message_flusher():
+    while True:
+        socketio.sleep(MESSAGE_FLUSH_SECONDS)
+        try:
+            flush_pending_messages()
+        except Exception as e:
+            print(f"[MessageBuffer] flush failed: {e}")
 
-# Helper to get a unique room name for two users
+def start_message_flusher():
+    if message_flusher['started']:
+        return
+    with pending_messages_lock:
+        if message_flusher['started']:
+            return
+        message_flusher['started'] = True
+    socketio.start_background_task(run_message_flusher)
 
-def get_room_name(user1, user2):
-    return '__'.join(sorted([user1, user2]))
+atexit.register(flush_pending_messages)
+
+@socketio.on('send_message')
+def handle_send_message(data):
+    # data: {receiver, content, audio?, sticker?}; the sender is always the session user
+    sender = session.get('username')
+    data = data or {}
+    receiver = data.get('receiver')
+    content = (data.get('content') or '').strip()
+    if not sender or not receiver or not content or not get_user_summary(receiver):
+        return {'success': False}
+    voice_note = decode_voice_note(data['audio']) if data.get('audio') else None
+    entry = queue_message(sender, receiver, content, voice_note)
+    if not entry['done'].wait(MESSAGE_ACK_TIMEOUT):
+        # Withdraw it so a failed ack never leaves a message behind for the client's retry to duplicate;
+        # one already taken by a flush is being written, so wait for that instead
+        with pending_messages_lock:
+            withdrawn = any(pending is entry for pending in pending_messages)
+            if withdrawn:
+                pending_messages[:] = [pending for pending in pending_messages if pending is not entry]
+        if withdrawn:
+            return {'success': False}
+        entry['done'].wait()
+    if entry['message'] is None:
+        return {'success': False}
+    # The row is stored with the '[sticker]' text; the sticker image itself is a shared static URL relayed live only
+    extra = {'sticker': data['sticker']} if data.get('sticker') else {}
+    payload = deliver_message(entry['message'], skip_sid=request.sid, **extra)
+    return {'success': True, 'id': payload['id'], 'message': payload}
+
+@socketio.on('read_messages')
+def handle_read_messages(data):
+    username = session.get('username')
+    partner = (data or {}).get('partner')
+    if not username or not partner:
+        return {'success': False}
+    mark_conversation_read(username, partner)
+    db.session.commit()
+    return {'success': True}
 
 # --- WebRTC signaling events for 1-to-1 calls ---
 @socketio.on('call-user')
@@ -1343,18 +2991,6 @@ def handle_end_call(data):
     else:
         print(f"[SocketIO] peer {peer} not in user_sid_map")
 
-@app.context_processor
-def inject_profile_pic_version():
-    version = None
-    if 'username' in session:
-        user = User.query.filter_by(username=session['username']).first()
-        if user and user.profile_pic_updated_at:
-            version = int(user.profile_pic_updated_at.timestamp())
-    if not version:
-        from datetime import datetime
-        version = int(datetime.utcnow().timestamp())
-    return {'profile_pic_version': version}
-
 @app.route('/invitation/<int:invitation_id>')
 def invitation_details(invitation_id):
     if 'username' not in session:
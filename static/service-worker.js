@@ -1,7 +1,87 @@
+// Served through the /service-worker.js route, which defines CACHE_VERSION and PRECACHE_URLS
+// (the fingerprinted shell assets) above this file so every deploy gets fresh cache names.
+const SHELL_CACHE = 'shell-' + CACHE_VERSION;
+const IMAGE_CACHE = 'images-v1';
+const PAGE_CACHE = 'pages-v1';
+const IMAGE_CACHE_MAX_ENTRIES = 200;
+const PAGE_NETWORK_TIMEOUT_MS = 3000;
+// Most recent feed and inbox pages, kept for instant opens and offline use
+const CACHED_PAGES = ['/', '/trip_posts', '/explore', '/messages'];
+const IMAGE_PREFIXES = ['/static/blobs/', '/static/derivatives/', '/static/trip_posts/', '/static/profile_pics/'];
+
 self.addEventListener('install', function(event) {
-  // You can cache files here if you want
-  console.log('Service Worker installed');
+  event.waitUntil(
+    caches.open(SHELL_CACHE)
+      .then(cache => cache.addAll(PRECACHE_URLS))
+      .then(() => self.skipWaiting())
+  );
 });
+
+self.addEventListener('activate', function(event) {
+  event.waitUntil(
+    caches.keys()
+      .then(names => Promise.all(
+        names.filter(name => name.startsWith('shell-') && name !== SHELL_CACHE).map(name => caches.delete(name))
+      ))
+      .then(() => self.clients.claim())
+  );
+});
+
 self.addEventListener('fetch', function(event) {
-  // You can serve cached files here if offline
+  const request = event.request;
+  const url = new URL(request.url);
+  if (request.method !== 'GET' || url.origin !== self.location.origin) return;
+  if (url.pathname === '/logout') {
+    // Cached pages belong to the signed-in user
+    event.waitUntil(caches.delete(PAGE_CACHE));
+    return;
+  }
+  if (PRECACHE_URLS.includes(url.pathname + url.search)) {
+    event.respondWith(caches.match(request).then(cached => cached || fetch(request)));
+  } else if (request.destination === 'image' && IMAGE_PREFIXES.some(prefix => url.pathname.startsWith(prefix))) {
+    event.respondWith(staleWhileRevalidate(event, request));
+  } else if (request.mode === 'navigate' && CACHED_PAGES.includes(url.pathname) && !url.search) {
+    event.respondWith(networkFirst(request));
+  }
 });
+
+function staleWhileRevalidate(event, request) {
+  return caches.open(IMAGE_CACHE).then(cache => cache.match(request).then(cached => {
+    const network = fetch(request).then(response => {
+      if (response.ok) {
+        cache.put(request, response.clone()).then(() => trimCache(IMAGE_CACHE, IMAGE_CACHE_MAX_ENTRIES));
+      }
+      return response;
+    });
+    if (cached) {
+      event.waitUntil(network.catch(() => {}));
+      return cached;
+    }
+    return network;
+  }));
+}
+
+function networkFirst(request) {
+  return caches.open(PAGE_CACHE).then(cache => {
+    const network = fetch(request).then(response => {
+      // Redirects (e.g. to login) are not worth replaying offline
+      if (response.ok && !response.redirected) {
+        cache.put(request, response.clone());
+      }
+      return response;
+    });
+    const timeout = new Promise(resolve => setTimeout(resolve, PAGE_NETWORK_TIMEOUT_MS));
+    const cachedAfterTimeout = timeout.then(() => cache.match(request)).then(cached => cached || network);
+    return Promise.race([network, cachedAfterTimeout])
+      .catch(() => cache.match(request).then(cached => cached || Response.error()));
+  });
+}
+
+// Keys come back in insertion order, so the oldest entries are dropped first
+function trimCache(name, maxEntries) {
+  return caches.open(name).then(cache => cache.keys().then(keys => {
+    if (keys.length > maxEntries) {
+      return Promise.all(keys.slice(0, keys.length - maxEntries).map(key => cache.delete(key)));
+    }
+  }));
+}
@@ -0,0 +1,83 @@
+import os
+import tempfile
+import threading
+
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'test.db')
+
+import pytest
+from sqlalchemy import event
+
+import app as partner_web
+from app import app, db, User, TripPost, TripPostLike, TripPostComment, TimelineEntry
+
+AUTHORS = ['alice', 'bob', 'carol']
+VIEWER = 'viewer'
+
+
+@pytest.fixture
+def client():
+    app.config['TESTING'] = True
+    # Keep the explore refresh out of the measured requests; an empty snapshot falls back to newest posts
+    partner_web.explore_state['refreshed_at'] = float('inf')
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        for username in AUTHORS + [VIEWER]:
+            db.session.add(User(username, 'pw', '', ''))
+        db.session.commit()
+    # Requests must run outside a pushed app context, or they share one g and its per-request memos
+    client = app.test_client()
+    client.post('/login', data={'username': VIEWER, 'password': 'pw'})
+    yield client
+    partner_web.presence_heartbeats.clear()
+    partner_web.dirty_presence.clear()
+    with app.app_context():
+        db.drop_all()
+
+
+def add_posts(count):
+    with app.app_context():
+        for i in range(count):
+            author = AUTHORS[i % len(AUTHORS)]
+            post = TripPost(author, f'post_{author}_{i}.jpg', f'Day {i} #travel')
+            db.session.add(post)
+            db.session.flush()
+            db.session.add(TimelineEntry(VIEWER, post.post_id, author, post.timestamp))
+            for liker in AUTHORS + [VIEWER]:
+                db.session.add(TripPostLike(post.post_id, liker))
+            for commenter in AUTHORS:
+                db.session.add(TripPostComment(post.post_id, commenter, f'Nice one {i}'))
+            post.like_count = len(AUTHORS) + 1
+            post.comment_count = len(AUTHORS)
+        db.session.commit()
+
+
+def count_queries(client, path):
+    # Process-wide caches would make the second measurement cheaper than the first
+    partner_web.user_summary_cache.clear()
+    partner_web.unread_counts.clear()
+    thread = threading.get_ident()
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if threading.get_ident() == thread:
+            statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', record)
+    try:
+        response = client.get(path)
+    finally:
+        event.remove(engine, 'before_cursor_execute', record)
+    assert response.status_code == 200
+    return len(statements)
+
+
+@pytest.mark.parametrize('path', ['/', '/trip_posts', '/explore'])
+def test_feed_query_count_does_not_grow_with_posts(client, path):
+    add_posts(5)
+    small = count_queries(client, path)
+    add_posts(10)
+    large = count_queries(client, path)
+    assert large == small